@@ -0,0 +1,8 @@
+import nonebot
+
+nonebot.init()  # the blackjack plugin package needs the driver when imported
+
+from src.plugins.blackjack.memory_benchmark import main
+
+if __name__ == "__main__":
+    main()
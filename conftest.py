@@ -0,0 +1,3 @@
+import nonebot
+
+nonebot.init()  # the plugin packages need the driver when imported, like in the scripts next to this one
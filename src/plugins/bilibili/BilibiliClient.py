@@ -1,12 +1,47 @@
+import asyncio
 import base64
 import json
 import time
-from io import BytesIO
-import requests
+import httpx
 import rsa
 from urllib import parse
 import hashlib
-from typing import List
+from typing import BinaryIO, List, Optional
+
+from .credentials import CredentialStore
+from .spool import IMAGE_SPOOL_BYTES, Uploadable, image_buffer
+from .upload_cache import UploadCache, content_hash
+
+# one pooled keep-alive client for every request, a slow bilibili api times out instead of hanging the handler:
+# httpx's timeouts are per connect, read and write, a server trickling its answer never trips them, so every request
+# also has HTTP_DEADLINE seconds overall (UPLOAD_DEADLINE for an image upload)
+HTTP_DEADLINE = 15
+HTTP_TIMEOUT = httpx.Timeout(HTTP_DEADLINE, connect=5)
+HTTP_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5)
+
+# fetching the images of a message, all at once but no more than IMAGE_FETCH_CONCURRENCY at a time
+IMAGE_FETCH_CONCURRENCY = 4
+IMAGE_MAX_BYTES = 20 * 1024 * 1024
+IMAGE_FETCH_TIMEOUT = 30  # seconds for one whole image, waiting for a free slot excluded
+
+
+# uploading the images of a dynamic, in parallel, retrying transient failures (network, 5xx, 429)
+UPLOAD_CONCURRENCY = 3
+UPLOAD_ATTEMPTS = 4
+UPLOAD_BACKOFF = 1  # seconds before the first retry, doubled before each next one
+UPLOAD_DEADLINE = 60  # seconds for one attempt
+
+# what bilibili answers when posting too often: the http status, or the code in the response
+RATE_LIMIT_STATUS = 429
+RATE_LIMIT_CODES = (-412, -509, -799)
+
+
+class ImageFetchError(Exception):
+    """an image couldn't be fetched, the message says why"""
+
+
+class RateLimited(RuntimeError):
+    """bilibili refused the dynamic for being posted too soon after the previous ones"""
 
 
 class BilibiliClient:
@@ -15,29 +50,40 @@ class BilibiliClient:
     SEND_TEXT_ONLY_URL = "https://api.vc.bilibili.com/dynamic_svr/v1/dynamic_svr/create"
     UPLOAD_IMG_URL = "https://api.vc.bilibili.com/api/v1/drawImage/upload"
 
-    def __init__(self, user_name: str = None, password: str = None):
-        self._session = requests.Session()
-        self._session.headers.update({"Referer": "https://www.bilibili.com", "User-Agent": "Mozilla/5.0"})
+    def __init__(self, user_name: str = None, password: str = None, image_concurrency: int = IMAGE_FETCH_CONCURRENCY,
+                 image_max_bytes: int = IMAGE_MAX_BYTES, image_timeout: float = IMAGE_FETCH_TIMEOUT,
+                 upload_cache: Optional[UploadCache] = None, spool_bytes: int = IMAGE_SPOOL_BYTES):
+        """
+        All requests are async, sharing a pooled httpx.AsyncClient, so none of them blocks the bot
+        It holds no draft, one client sends the dynamics of every user, see drafts.py
+        With a user name and password, call `await login()` before use, otherwise __init__.py should set the cookies
+        :param upload_cache: images found in it aren't uploaded again
+        :param spool_bytes: images bigger than this are held in temp files instead of in memory
+        """
+        self._session = httpx.AsyncClient(headers={"Referer": "https://www.bilibili.com", "User-Agent": "Mozilla/5.0"},
+                                          timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
 
         self.username, self.password = user_name, password
         self.access_token: str = ''
         self.refresh_token: str = ''
+        self.credentials: Optional[CredentialStore] = None  # where new cookies and tokens are saved, if anywhere
 
-        # these 2 are used to hold the stuff to be sent
-        self.dynamic_text = ''
-        self.dynamic_img_list: List[BytesIO] = []
+        self.image_concurrency, self.image_max_bytes, self.image_timeout = image_concurrency, image_max_bytes, image_timeout
+        self._image_slots: Optional[asyncio.Semaphore] = None  # made on first use, in the bot's event loop
+        self._upload_slots: Optional[asyncio.Semaphore] = None  # same
+        self.upload_cache = upload_cache
+        self.spool_bytes = spool_bytes
 
-        if self.username and self.password:
-            self.login()  # login with password on object creation
-        # else __init__.py should set the cookies
+    async def aclose(self):
+        """closes the pooled connections, on shutdown"""
+        await self._session.aclose()
 
-    def clear(self):
-        """
-        clears stored stuff like dynamic_text and dynamic_img_list
-        It doesn't clear itself after sending, but relies on the driver code (bot) to call clear on the object when needed
-        """
-        self.dynamic_text = ''
-        self.dynamic_img_list = []
+    async def _request(self, method: str, url: str, deadline: float = HTTP_DEADLINE, **kwargs) -> httpx.Response:
+        """a request on the pooled client, raises httpx.TimeoutException if it takes over `deadline` seconds in all"""
+        try:
+            return await asyncio.wait_for(self._session.request(method, url, **kwargs), deadline)
+        except asyncio.TimeoutError:
+            raise httpx.TimeoutException(f'{method} {url} took over {deadline}s') from None
 
     @staticmethod
     def calc_sign(param):
@@ -46,27 +92,36 @@ class BilibiliClient:
         sign_hash.update(f"{param}{salt}".encode())
         return sign_hash.hexdigest()
 
-    def _solve_captcha(self, image):
+    async def _solve_captcha(self, image):
         url = "https://bili.dev:2233/captcha"
         payload = {'image': base64.b64encode(image).decode("utf-8")}
-        response = self._session.post(url, json=payload).json()
+        response = (await self._request('POST', url, json=payload)).json()
         return response['message'] if response and response.get("code") == 0 else None
 
-    def login(self):
-        def get_key():
+    async def _use_credentials(self, response: dict):
+        """takes the cookies and tokens of a login or refresh response, and saves them"""
+        for cookie in response['data']['cookie_info']['cookies']:
+            self._session.cookies.set(cookie['name'], cookie['value'], domain=".bilibili.com")
+        self.access_token = response['data']['token_info']['access_token']
+        self.refresh_token = response['data']['token_info']['refresh_token']
+        if self.credentials is not None:
+            await self.credentials.update(response)
+
+    async def login(self):
+        async def get_key():
             url = "https://passport.bilibili.com/api/oauth2/getKey"
             payload = {
                 'appkey': self.APP_KEY,
                 'sign'  : self.calc_sign(f"appkey={self.APP_KEY}"),
             }
-            response = self._session.post(url, data=payload).json()
+            response = (await self._request('POST', url, data=payload)).json()
             if response and response.get("code") == 0:
                 return {
                     'key_hash': response['data']['hash'],
                     'pub_key' : rsa.PublicKey.load_pkcs1_openssl_pem(response['data']['key'].encode()),
                 }
 
-        key = get_key()
+        key = await get_key()
         key_hash, pub_key = key['key_hash'], key['pub_key']
         url = "https://passport.bilibili.com/api/v2/oauth2/login"
         param = f"appkey={self.APP_KEY}" \
@@ -74,17 +129,17 @@ class BilibiliClient:
                 f"&username={parse.quote_plus(self.username)}"
         payload = f"{param}&sign={self.calc_sign(param)}"
         headers = {'Content-type': "application/x-www-form-urlencoded"}
-        response = self._session.post(url, data=payload, headers=headers).json()
+        response = (await self._request('POST', url, content=payload, headers=headers)).json()
 
         if response and response.get("code") is not None:
             if response['code'] == -105:
                 url = "https://passport.bilibili.com/captcha"
                 headers = {'Host': "passport.bilibili.com"}
-                response = self._session.get(url, headers=headers).content
-                captcha = self._solve_captcha(response)
+                response = (await self._request('GET', url, headers=headers)).content
+                captcha = await self._solve_captcha(response)
                 if captcha:
                     print(f"登录验证码识别结果: {captcha}")
-                    key = get_key()
+                    key = await get_key()
                     key_hash, pub_key = key['key_hash'], key['pub_key']
                     url = "https://passport.bilibili.com/api/v2/oauth2/login"
                     param = f"appkey={self.APP_KEY}&captcha={captcha}" \
@@ -92,7 +147,7 @@ class BilibiliClient:
                             f"&username={parse.quote_plus(self.username)}"
                     payload = f"{param}&sign={self.calc_sign(param)}"
                     headers = {'Content-type': "application/x-www-form-urlencoded"}
-                    response = self._session.post(url, data=payload, headers=headers)
+                    response = await self._request('POST', url, content=payload, headers=headers)
                     print('captcha finished with text:', response.text)
                 else:
                     print('captcha service unavailable')
@@ -107,20 +162,14 @@ class BilibiliClient:
                         f"&username={parse.quote_plus(self.username)}&validate="
                 payload = f"{param}&sign={self.calc_sign(param)}"
                 headers = {'Content-type': "application/x-www-form-urlencoded"}
-                response = self._session.post(url, data=payload, headers=headers).json()
+                response = (await self._request('POST', url, content=payload, headers=headers)).json()
                 print('got code -449, using v3 api, response text:', response)
 
-                for cookie in response['data']['cookie_info']['cookies']:
-                    self._session.cookies.set(cookie['name'], cookie['value'], domain=".bilibili.com")
-                self.access_token = response['data']['token_info']['access_token']
-                self.refresh_token = response['data']['token_info']['refresh_token']
+                await self._use_credentials(response)
 
             elif response['code'] == 0 and response['data']['status'] == 0:
                 print('login successful with json response:', response)
-                for cookie in response['data']['cookie_info']['cookies']:
-                    self._session.cookies.set(cookie['name'], cookie['value'], domain=".bilibili.com")
-                self.access_token = response['data']['token_info']['access_token']
-                self.refresh_token = response['data']['token_info']['refresh_token']
+                await self._use_credentials(response)
                 print("登录成功")
                 return True
 
@@ -129,38 +178,79 @@ class BilibiliClient:
         else:
             print('login failed, no response code:', response)
 
-    def get_image(self, url: str) -> bool:
+    async def _download_image(self, url: str) -> BinaryIO:
+        buffer = image_buffer(self.spool_bytes)
+        try:
+            async with self._session.stream('GET', url) as response:
+                response.raise_for_status()
+                too_big = ImageFetchError(f'图片超过{self.image_max_bytes / 2 ** 20:g}MB')
+                if int(response.headers.get('Content-Length') or 0) > self.image_max_bytes:
+                    raise too_big
+                async for chunk in response.aiter_bytes():
+                    buffer.write(chunk)
+                    if buffer.tell() > self.image_max_bytes:  # the length may be missing or wrong
+                        raise too_big
+        except BaseException:  # timed out and cancelled too
+            buffer.close()
+            raise
+        buffer.seek(0)
+        return buffer
+
+    async def fetch_image(self, url: str) -> BinaryIO:
+        """downloads one image, within the concurrency, size and time limits; raises ImageFetchError if it can't"""
+        if self._image_slots is None:
+            self._image_slots = asyncio.Semaphore(self.image_concurrency)
+        async with self._image_slots:
+            try:
+                return await asyncio.wait_for(self._download_image(url), self.image_timeout)
+            except asyncio.TimeoutError:
+                raise ImageFetchError(f'下载超过{self.image_timeout}秒')
+            except (httpx.HTTPError, httpx.InvalidURL) as e:
+                raise ImageFetchError(f'下载失败（{type(e).__name__}）')
+
+    async def get_images(self, urls: List[str], images: List[BinaryIO]) -> List[Optional[str]]:
+        """
+        Gets all the images at once and appends the ones fetched to `images`, in order, so it takes as long as the
+        slowest one
+        :return for each url, None if fetched, otherwise why not
         """
-        Use http request to get the image from the url and store it as bytes.
+        results = await asyncio.gather(*map(self.fetch_image, urls), return_exceptions=True)
+        errors = []
+        for result in results:
+            if isinstance(result, ImageFetchError):
+                errors.append(str(result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                images.append(result)
+                errors.append(None)
+        return errors
+
+    async def get_image(self, url: str, images: List[BinaryIO]) -> bool:
+        """
+        Use http request to get the image from the url and append it to `images`.
         :return operation successful or not
         """
-        try:
-            img_bytes = BytesIO(requests.get(url).content)
-        except:
-            return False
-        self.dynamic_img_list.append(img_bytes)
-        return True
-
-    # DON'T call this, unless login by password works again, which sets the tokens
-    def refresh(self):
+        return (await self.get_images([url], images))[0] is None
+
+    async def refresh(self) -> bool:
+        """refreshes the tokens, which must be set, see CredentialStore.keep_fresh; :return whether it worked"""
         url = "https://passport.bilibili.com/api/v2/oauth2/refresh_token"
         param = f"access_key={self.access_token}&appkey={self.APP_KEY}&refresh_token={self.refresh_token}&ts={int(time.time())}"
         payload = f"{param}&sign={self.calc_sign(param)}"
         headers = {'Content-type': "application/x-www-form-urlencoded"}
-        response = self._session.post(url, data=payload, headers=headers).json()
+        response = (await self._request('POST', url, content=payload, headers=headers)).json()
         print('response from refresh token post request', response)
         if response and response.get("code") == 0:
-            # also records the new response in the file
-            with open('bilibili.txt', 'w') as fp:
-                fp.write(json.dumps(response))
-
-            for cookie in response['data']['cookie_info']['cookies']:
-                self._session.cookies.set(cookie['name'], cookie['value'], domain=".bilibili.com")
-            self.access_token = response['data']['token_info']['access_token']
-            self.refresh_token = response['data']['token_info']['refresh_token']
+            await self._use_credentials(response)  # also records the new response in the file
+            return True
+        return False
 
-    def send_dynamic(self):
-        """Sends a bilibili dynamic (dong tai) with the received text/images, doesn't handle at's (i.e. @someone)"""
+    async def send_dynamic(self, text: str, images: List[BinaryIO]):
+        """
+        Sends a bilibili dynamic (dong tai) with the text and the first 9 images, doesn't handle at's (i.e. @someone)
+        The images are left open, they belong to the caller
+        """
         def get_text_dynamic_payload():
             """
             不解析并忽略@人数据
@@ -171,7 +261,7 @@ class BilibiliClient:
                 "dynamic_id": 0,
                 "type"      : 4,
                 "rid"       : 0,
-                "content"   : self.dynamic_text.strip(),
+                "content"   : text.strip(),
                 "extension" : "{\"emoji_type\":1}",
                 "at_uids"   : "",
                 "ctrl"      : "",
@@ -180,15 +270,15 @@ class BilibiliClient:
             }
             return data
 
-        def get_img_dynamic_payload():
+        async def get_img_dynamic_payload():
             """
             不解析并忽略@人数据
 
             :return: 带图片和文字动态的POST payload
             """
-            def upload_image(img_bytes: BytesIO):
+            async def upload_image(img_bytes: BinaryIO):
                 """
-                uploads the image (as bytes) to bilibili
+                uploads the image (as bytes) to bilibili, retrying with exponential backoff on transient failures
 
                 :return: api response json data
                 """
@@ -198,22 +288,55 @@ class BilibiliClient:
                     "csrf": self._session.cookies.get('bili_jct'),
                     "csrf_token": self._session.cookies.get('bili_jct')
                 }
-                response = self._session.post(self.UPLOAD_IMG_URL, data=form_data, files={'file_up': img_bytes}).json()
+                for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+                    try:
+                        async with self._upload_slots:  # no slot is held while backing off
+                            img_bytes.seek(0)  # a failed attempt may have read it
+                            # multipart streams the file in chunks, it's never read whole into memory
+                            response = await self._request('POST', self.UPLOAD_IMG_URL, UPLOAD_DEADLINE,
+                                                           data=form_data,
+                                                           files={'file_up': ('upload', Uploadable(img_bytes))})
+                        if response.status_code == 429 or response.status_code >= 500:
+                            response.raise_for_status()
+                        response = response.json()
+                        break
+                    except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                        if attempt == UPLOAD_ATTEMPTS:
+                            raise RuntimeError(f'图片上传{UPLOAD_ATTEMPTS}次都失败了：{e!r}')
+                        delay = UPLOAD_BACKOFF * 2 ** (attempt - 1)
+                        print(f'upload image attempt {attempt} failed: {e!r}, retrying in {delay}s')
+                        await asyncio.sleep(delay)
                 print('response from upload image:', response)
                 if response['code'] != 0:
                     print('upload image response:', response)
                     raise RuntimeError(response)
                 return response['data']
 
+            async def cached_upload(img_bytes: BinaryIO):
+                """the upload response data of an identical image uploaded before if any, otherwise uploads it"""
+                if self.upload_cache is None:
+                    return await upload_image(img_bytes)
+                key = await content_hash(img_bytes)
+                info = self.upload_cache.get(key)
+                if info is None:
+                    info = await upload_image(img_bytes)
+                    self.upload_cache.put(key, info)
+                return info
+
             def extract_infos(img_info):
                 """extract some of the response needed for posting dynamic"""
                 print('response from uploading image:', img_info)
                 return {"img_src": img_info["image_url"], "img_width": img_info["image_width"], "img_height": img_info["image_height"]}
 
-            img_responses = []
-            for img in self.dynamic_img_list:
-                info = upload_image(img)
-                img_responses.append(info)
+            # all uploaded in parallel, gather keeps the order of the images
+            if self._upload_slots is None:
+                self._upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+            img_responses = await asyncio.gather(*map(cached_upload, images), return_exceptions=True)
+            if self.upload_cache is not None:
+                await self.upload_cache.save()  # with the ones uploaded, even if some failed
+            for result in img_responses:
+                if isinstance(result, BaseException):
+                    raise result  # after all of them finished, nothing keeps uploading in the background
 
             img_infos = list(map(extract_infos, img_responses))
             data = {
@@ -223,8 +346,8 @@ class BilibiliClient:
                 "pictures"         : json.dumps(img_infos),
                 "title"            : "",
                 "tags"             : "",
-                "description"      : self.dynamic_text.strip(),
-                "content"          : self.dynamic_text.strip(),
+                "description"      : text.strip(),
+                "content"          : text.strip(),
                 "from"             : "create.dynamic.web",
                 "up_choose_comment": 0,
                 "extension"        : json.dumps({"emoji_type": 1, "from": {"emoji_type": 1}, "flag_cfg": {}}),
@@ -239,15 +362,29 @@ class BilibiliClient:
             }
             return data
 
-        if len(self.dynamic_img_list) == 0:  # no images, text only
-            if len(self.dynamic_text) == 0:  # nothing to send
+        if len(images) == 0:  # no images, text only
+            if len(text) == 0:  # nothing to send
                 raise RuntimeError('无可发送消息内容，图片文字均为空')
             payload = get_text_dynamic_payload()
-            response = self._session.post(self.SEND_TEXT_ONLY_URL, data=payload)
+            response = await self._request('POST', self.SEND_TEXT_ONLY_URL, data=payload)
             print('response from sending pure text dynamic', response.text)
+            self._check_sent(response)
 
         else:  # has images
-            self.dynamic_img_list = self.dynamic_img_list[:9]  # allow max 9 images
-            payload = get_img_dynamic_payload()
-            response = self._session.post(self.SEND_WITH_IMG_URL, data=payload)
+            images = images[:9]  # allow max 9 images
+            payload = await get_img_dynamic_payload()
+            response = await self._request('POST', self.SEND_WITH_IMG_URL, data=payload)
             print('response from sending img dynamic', response.text)
+            self._check_sent(response)
+
+    @staticmethod
+    def _check_sent(response: httpx.Response):
+        """raises if the dynamic wasn't posted, so whoever sends it knows to retry, RateLimited to slow down too"""
+        if response.status_code == RATE_LIMIT_STATUS:
+            raise RateLimited(f'发送太频繁（HTTP {response.status_code}）')
+        response.raise_for_status()
+        result = response.json()
+        if result.get('code') in RATE_LIMIT_CODES:
+            raise RateLimited(f"发送太频繁：{result.get('message') or result}")
+        if result.get('code') != 0:
+            raise RuntimeError(f"发送失败：{result.get('message') or result}")
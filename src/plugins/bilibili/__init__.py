@@ -1,23 +1,22 @@
-from typing import List
+import asyncio
+import time
+from datetime import datetime
+from typing import List, Optional
 from nonebot.rule import to_me, Rule
 from nonebot.typing import T_State
 from nonebot.adapters.cqhttp import Bot, Event, MessageSegment, Message, MessageEvent
-from nonebot import on_regex
-from .BilibiliClient import BilibiliClient
+from nonebot import on_regex, get_driver, get_bots
+from .BilibiliClient import BilibiliClient, IMAGE_FETCH_CONCURRENCY, IMAGE_MAX_BYTES, IMAGE_FETCH_TIMEOUT
+from .image_processing import ImageProcessor, IMAGE_MAX_SIDE, IMAGE_TARGET_BYTES, IMAGE_WORKERS
+from .upload_cache import UploadCache, UPLOAD_CACHE_FILE, UPLOAD_CACHE_SIZE, UPLOAD_CACHE_TTL
+from .spool import IMAGE_SPOOL_BYTES
+from .credentials import CredentialStore, CREDENTIALS_FILE
+from .drafts import Draft, DraftRegistry, DRAFT_TIMEOUT
+from .post_queue import PostQueue, QueuedPost, QUEUE_DB, QUEUE_IMAGE_DIR, POST_INTERVAL, POST_ATTEMPTS, SENT
 import re
-import json
 
 # check against this list so that not anyone can use send dynamic
 ALLOWED_USERS_QQ = ['1092997224', '1330992777']  # me and malivergos
-FP = open('bilibili.txt', 'r')
-INFOS = json.load(FP)
-COOKIES = INFOS['data']['cookie_info']['cookies']
-try:
-    ACCESS_TOKEN = INFOS['data']['token_info']['access_token']
-    REFRESH_TOKEN = INFOS['data']['token_info']['refresh_token']
-except:
-    ACCESS_TOKEN, REFRESH_TOKEN = None, None
-FP.close()
 
 
 def is_qualified_user() -> Rule:
@@ -31,19 +30,94 @@ def is_qualified_user() -> Rule:
 # USER_NAME, PASSWORD = lines[0].strip(), lines[1].strip()
 
 # CLIENT = BilibiliClient(USER_NAME, PASSWORD)
-CLIENT = BilibiliClient()
-for cookie in COOKIES:
-    CLIENT._session.cookies.set(cookie['name'], cookie['value'], domain=".bilibili.com")
-CLIENT.access_token, CLIENT.refresh_token = ACCESS_TOKEN, REFRESH_TOKEN
-# CLIENT.refresh()  # refresh at launch
+config = get_driver().config
+# BILIBILI_IMAGE_CONCURRENCY, BILIBILI_IMAGE_MAX_MB and BILIBILI_IMAGE_TIMEOUT in .env override the defaults
+IMAGE_CONCURRENCY = int(getattr(config, 'bilibili_image_concurrency', IMAGE_FETCH_CONCURRENCY))
+IMAGE_MAX_MB = float(getattr(config, 'bilibili_image_max_mb', IMAGE_MAX_BYTES / 2 ** 20))
+IMAGE_TIMEOUT = float(getattr(config, 'bilibili_image_timeout', IMAGE_FETCH_TIMEOUT))
+# BILIBILI_IMAGE_SPOOL_KB: images bigger than this go to temp files
+IMAGE_SPOOL_BYTES = int(float(getattr(config, 'bilibili_image_spool_kb', IMAGE_SPOOL_BYTES / 1024)) * 1024)
+# BILIBILI_UPLOAD_CACHE_FILE, BILIBILI_UPLOAD_CACHE_SIZE (entries) and BILIBILI_UPLOAD_CACHE_DAYS as well
+UPLOAD_CACHE = UploadCache(path=getattr(config, 'bilibili_upload_cache_file', UPLOAD_CACHE_FILE),
+                           max_entries=int(getattr(config, 'bilibili_upload_cache_size', UPLOAD_CACHE_SIZE)),
+                           ttl=float(getattr(config, 'bilibili_upload_cache_days', UPLOAD_CACHE_TTL / 86400)) * 86400)
+CLIENT = BilibiliClient(image_concurrency=IMAGE_CONCURRENCY, image_max_bytes=int(IMAGE_MAX_MB * 2 ** 20),
+                        image_timeout=IMAGE_TIMEOUT, upload_cache=UPLOAD_CACHE, spool_bytes=IMAGE_SPOOL_BYTES)
+# BILIBILI_CREDENTIALS_FILE, the cookies and tokens, read at startup
+CREDENTIALS = CredentialStore(getattr(config, 'bilibili_credentials_file', CREDENTIALS_FILE))
+CLIENT.credentials = CREDENTIALS
+# BILIBILI_DRAFT_TIMEOUT: minutes a draft is kept without input
+DRAFTS = DraftRegistry(timeout=float(getattr(config, 'bilibili_draft_timeout', DRAFT_TIMEOUT / 60)) * 60)
+# BILIBILI_QUEUE_DB, BILIBILI_QUEUE_IMAGE_DIR, BILIBILI_POST_INTERVAL (seconds) and BILIBILI_POST_ATTEMPTS
+QUEUE = PostQueue(db_path=getattr(config, 'bilibili_queue_db', QUEUE_DB),
+                  image_dir=getattr(config, 'bilibili_queue_image_dir', QUEUE_IMAGE_DIR),
+                  interval=float(getattr(config, 'bilibili_post_interval', POST_INTERVAL)),
+                  attempts=int(getattr(config, 'bilibili_post_attempts', POST_ATTEMPTS)))
+# /发送 18:00 or /发送 2021-06-01 18:00 sends at that time
+SCHEDULE_PATTERN = re.compile(r'(?:(\d{4})-(\d{1,2})-(\d{1,2}) +)?(\d{1,2})[:：](\d{2})')
+
+
+def publish_time(msg: str) -> Optional[float]:
+    """the time asked for in `msg` as a timestamp, a time alone is today's; None for right away"""
+    match = SCHEDULE_PATTERN.search(msg)
+    if match is None:
+        return None
+    year, month, day, hour, minute = match.groups()
+    now = datetime.now()
+    if year is None:
+        when = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    else:
+        when = datetime(int(year), int(month), int(day), int(hour), int(minute))
+    return when.timestamp()
+
+
+async def notify_poster(post: QueuedPost):
+    """tells the one who queued `post` it was sent, or given up"""
+    result = '发送成功' if post.status == SENT else f'发送失败，已放弃\n{post.error}'
+    for bot in get_bots().values():
+        await bot.send_private_msg(user_id=int(post.qq), message=f'动态 #{post.id} {result}')
+        break
+
+
+# BILIBILI_IMAGE_MAX_SIDE (pixels), BILIBILI_IMAGE_TARGET_MB and BILIBILI_IMAGE_WORKERS (threads) too
+PROCESSOR = ImageProcessor(max_side=int(getattr(config, 'bilibili_image_max_side', IMAGE_MAX_SIDE)),
+                           target_bytes=int(float(getattr(config, 'bilibili_image_target_mb',
+                                                          IMAGE_TARGET_BYTES / 2 ** 20)) * 2 ** 20),
+                           workers=int(getattr(config, 'bilibili_image_workers', IMAGE_WORKERS)),
+                           spool_bytes=IMAGE_SPOOL_BYTES)
+
+
+refresher: Optional[asyncio.Task] = None  # CREDENTIALS.keep_fresh
+
+
+@get_driver().on_startup
+async def load_credentials():
+    global refresher
+    await CREDENTIALS.load()
+    await UPLOAD_CACHE.load()
+    CREDENTIALS.apply(CLIENT)
+    refresher = asyncio.ensure_future(CREDENTIALS.keep_fresh(CLIENT))  # refreshes at launch if they're due
+    DRAFTS.start()
+    QUEUE.start(CLIENT, notify_poster)
+
+
+@get_driver().on_shutdown
+async def close_client():
+    if refresher is not None:
+        refresher.cancel()
+    DRAFTS.stop()
+    await QUEUE.stop()
+    await CLIENT.aclose()
+    PROCESSOR.shutdown()
+
 
 dynamic = on_regex('发动态', rule=to_me() & is_qualified_user())
 
 
 @dynamic.handle()
 async def first_receive(bot: Bot, event: MessageEvent, state: T_State):
-    CLIENT.clear()  # make sure to start afresh
-    # CLIENT.refresh()  # also refreshes its cookies and tokens
+    if not DRAFTS.open(event.get_user_id(), Draft()):  # a new draft, to start afresh
+        await dynamic.finish('正在写的动态太多了，稍后再试')
     await dynamic.send('接收中')
 
 
@@ -55,45 +129,104 @@ async def received(bot: Bot, event: MessageEvent, state: T_State):
     #     # return
 
     msg: Message = event.get_message()
+    sender_qq = event.get_user_id()
 
     if re.compile('/取消').match(str(msg)):
-        CLIENT.clear()
+        DRAFTS.close(sender_qq)
         await dynamic.finish('已取消')
 
     if re.compile('/发送|/结束').match(str(msg)):
+        # queued, the dispatcher sends it and tells the sender how it went
+        try:
+            publish_at = publish_time(str(msg))
+        except ValueError:  # no such date
+            await dynamic.reject('时间不对，格式是 /发送 18:00 或 /发送 2021-06-01 18:00')
+        if publish_at is not None and publish_at <= time.time():
+            await dynamic.reject('这个时间已经过了，换个时间再 /发送，或者只发 /发送 尽快发出')
+        draft = DRAFTS.take(sender_qq)
+        if draft is None:
+            await dynamic.finish('草稿已过期，请重新发动态')
+        if not draft.text.strip() and not draft.images:
+            draft.close()
+            await dynamic.finish('无可发送消息内容，图片文字均为空')
         try:
-            CLIENT.send_dynamic()
-        except Exception as e:
-            await dynamic.finish('发送时出现错误\n' + str(e))
-        await dynamic.finish('发送成功')
+            post_id = await QUEUE.add(sender_qq, draft.text, draft.images[:9], publish_at)  # allow max 9 images
+        except Exception as e:  # the queue's db or disk, the draft is kept to try again
+            print('bilibili post not queued:', repr(e))
+            if DRAFTS.open(sender_qq, draft):
+                await dynamic.reject('加入队列失败，草稿还在，稍后再 /发送')
+            draft.close()
+            await dynamic.finish('加入队列失败，草稿也没能保留，请重新发动态')
+        draft.close()
+        when = time.strftime('%m-%d %H:%M', time.localtime(publish_at)) if publish_at else '尽快'
+        await dynamic.finish(f'已加入发送队列：#{post_id}，{when}发送，发送 /队列 查看')
+
+    draft = DRAFTS.get(sender_qq)
+    if draft is None:
+        await dynamic.finish('草稿已过期，请重新发动态')
 
     # get the text and images from user input message
     img_segments: List[MessageSegment] = list(filter(lambda m: m.type == 'image', msg))
     text_segments: List[MessageSegment] = list(filter(lambda m: m.type == 'text', msg))
-    if len(img_segments) > 0:  # has images
-        for i, img in enumerate(img_segments, 1):
-            img_url = img.data['url']
-            print('get img called with url:', img_url)
-            if not CLIENT.get_image(img_url):
-                await dynamic.send(f'无法接收第{i}张图片')
-        # await dynamic.send(f'共收到{len(CLIENT.dynamic_img_list)}张图片')
-        await dynamic.reject(f'共收到{len(CLIENT.dynamic_img_list)}张图片')
+    if len(img_segments) > 0:  # has images, fetched all at once
+        img_urls = [img.data['url'] for img in img_segments]
+        print('get images called with urls:', img_urls)
+        received_before = len(draft.images)
+        errors = await CLIENT.get_images(img_urls, draft.images)
+        failures = [f'第{i}张：{error}' for i, error in enumerate(errors, 1) if error]
+        if failures:
+            await dynamic.send('无法接收以下图片\n' + '\n'.join(failures))
+        # shrink the new ones now, so sending doesn't wait for it
+        draft.images[received_before:], saved = await PROCESSOR.shrink_all(draft.images[received_before:])
+        print(f'image processing saved {saved} bytes')
+        # await dynamic.send(f'共收到{len(draft.images)}张图片')
+        await dynamic.reject(f'共收到{len(draft.images)}张图片'
+                             + (f'，压缩省下{saved / 2 ** 20:.1f}MB' if saved >= 2 ** 20 / 10 else ''))
 
     if len(text_segments) > 0:  # has text, concat all text segments and append
-        CLIENT.dynamic_text += '\n' + ''.join(map(str, text_segments))
+        draft.text += '\n' + ''.join(map(str, text_segments))
         # await dynamic.send('收到一段文字')
         await dynamic.reject('收到一段文字')
 
     ###await dynamic.reject('继续接收中，输入 /发送 即可发布动态')
 
 
+upload_cache_stats = on_regex('/图片缓存', rule=to_me() & is_qualified_user())
+
+
+@upload_cache_stats.handle()
+async def show_upload_cache_stats(bot: Bot, event: MessageEvent, state: T_State):
+    await upload_cache_stats.finish(UPLOAD_CACHE.stats())
+
+
+post_queue_status = on_regex('^/队列', rule=to_me() & is_qualified_user())
+
+
+@post_queue_status.handle()
+async def show_post_queue(bot: Bot, event: MessageEvent, state: T_State):
+    posts = await QUEUE.posts_of(event.get_user_id())
+    await post_queue_status.finish('\n'.join(post.describe() for post in posts) if posts else '队列里没有你的动态')
+
+
+CANCEL_POST_PATTERN = re.compile(r'^/撤销 *#?(\d+)')
+cancel_post = on_regex(CANCEL_POST_PATTERN.pattern, rule=to_me() & is_qualified_user())
+
+
+@cancel_post.handle()
+async def cancel_queued_post(bot: Bot, event: MessageEvent, state: T_State):
+    post_id = int(CANCEL_POST_PATTERN.search(str(event.get_message())).group(1))
+    if await QUEUE.cancel(event.get_user_id(), post_id):
+        await cancel_post.finish(f'已撤销 #{post_id}')
+    await cancel_post.finish(f'#{post_id} 不是你等待发送的动态')
+
+
 # call the login method on CLIENT
 manual_login = on_regex('/登录|/登陆', rule=to_me() & is_qualified_user())
 
 
 @manual_login.handle()
 async def client_login(bot: Bot, event: MessageEvent, state: T_State):
-    if CLIENT.login():
+    if await CLIENT.login():
         await manual_login.finish('登录成功')
     else:
         await manual_login.finish('登录遇到一些意外，但不一定失败了')
@@ -125,16 +258,14 @@ async def prompt_set_cookies(bot: Bot, event: MessageEvent, state: T_State):
 @manual_set_cookies.receive()
 async def set_cookies(bot: Bot, event: MessageEvent, state: T_State):
     cookies_msg = str(event.get_message()).split(';')
-    with open('bilibili.txt', 'r') as fp:
-        original_json = json.load(fp)
-
-    original_json['data']['cookie_info']['cookies'] = []
+    cookies = {}
     for cookie_str in cookies_msg:
         name_val_pair = cookie_str.strip()
+        if not name_val_pair:  # after the last ;
+            continue
         name_val_list = name_val_pair.split('=')
         cookie_name, cookie_value = name_val_list[0].strip(), name_val_list[1].strip()
         CLIENT._session.cookies.set(cookie_name, cookie_value, domain=".bilibili.com")
-        original_json['data']['cookie_info']['cookies'].append({"name": cookie_name, "value": cookie_value})
-    with open('bilibili.txt', 'w') as fp:
-        fp.write(json.dumps(original_json))
+        cookies[cookie_name] = cookie_value
+    await CREDENTIALS.set_cookies(cookies)
     await manual_set_cookies.finish('cookies设置完毕')
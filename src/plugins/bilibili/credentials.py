@@ -0,0 +1,102 @@
+"""
+The cookies and tokens of the bilibili account, kept in a json file (bilibili.txt): the response of the last login or
+token refresh, plus when it was saved. Read at startup in a thread (`load`), and written atomically so a crash
+mid-write can't lose it.
+
+`keep_fresh` runs in the background and refreshes the tokens REFRESH_AHEAD before they expire, so posting never waits
+for a refresh, nor fails because the tokens lapsed.
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from .storage import save_atomic
+
+CREDENTIALS_FILE = 'bilibili.txt'
+TOKEN_LIFETIME = 30 * 24 * 60 * 60  # seconds, when the file doesn't say
+REFRESH_AHEAD = 3 * 24 * 60 * 60  # seconds before the expiry
+REFRESH_RETRY = 10 * 60  # seconds after a failed refresh
+REFRESH_CHECK = 12 * 60 * 60  # seconds between checks at most, the file may change meanwhile
+
+
+class CredentialStore:
+    def __init__(self, path: str = CREDENTIALS_FILE):
+        self.path = path
+        self._infos: Optional[Dict] = None  # what the file holds, None until loaded
+
+    def _load(self) -> Dict:
+        if self._infos is None:
+            try:
+                with open(self.path, 'r') as fp:
+                    self._infos = json.load(fp)
+            except FileNotFoundError:
+                print('no bilibili credentials in', self.path, ', log in or set the cookies')
+                self._infos = {}
+            # files written before the time was recorded: as old as the file
+            if 'saved_at' not in self._infos and os.path.exists(self.path):
+                self._infos['saved_at'] = os.path.getmtime(self.path)
+        return self._infos
+
+    async def load(self):
+        """reads the file in a thread, so the event loop doesn't wait on the disk"""
+        await asyncio.get_running_loop().run_in_executor(None, self._load)
+
+    @property
+    def cookies(self) -> List[Dict]:
+        """[{'name': ..., 'value': ...}]"""
+        return self._load().get('data', {}).get('cookie_info', {}).get('cookies', [])
+
+    @property
+    def token_info(self) -> Dict:
+        return self._load().get('data', {}).get('token_info', {})
+
+    @property
+    def expires_at(self) -> Optional[float]:
+        """when the tokens expire, None without tokens"""
+        if not self.token_info.get('refresh_token'):
+            return None
+        return self._load().get('saved_at', time.time()) + self.token_info.get('expires_in', TOKEN_LIFETIME)
+
+    def apply(self, client):
+        """gives `client` the cookies and tokens"""
+        for cookie in self.cookies:
+            client._session.cookies.set(cookie['name'], cookie['value'], domain=".bilibili.com")
+        client.access_token = self.token_info.get('access_token')
+        client.refresh_token = self.token_info.get('refresh_token')
+
+    async def save(self):
+        data = json.dumps(self._load())
+        await save_atomic(self.path, data)
+
+    async def update(self, response: Dict):
+        """stores the response of a login or a token refresh"""
+        self._infos = dict(response, saved_at=time.time())
+        await self.save()
+
+    async def set_cookies(self, cookies: Dict[str, str]):
+        """replaces the cookies, keeping the tokens"""
+        infos = self._load()
+        infos.setdefault('data', {}).setdefault('cookie_info', {})['cookies'] = \
+            [{"name": name, "value": value} for name, value in cookies.items()]
+        await self.save()
+
+    async def keep_fresh(self, client):
+        """refreshes the tokens of `client` ahead of their expiry, forever; run it as a task"""
+        while True:
+            expires_at = self.expires_at
+            if expires_at is None:  # nothing to refresh with until a login
+                await asyncio.sleep(REFRESH_CHECK)
+                continue
+            delay = expires_at - REFRESH_AHEAD - time.time()
+            if delay > 0:
+                await asyncio.sleep(min(delay, REFRESH_CHECK))
+                continue
+            try:
+                refreshed = await client.refresh()  # which calls update with the response
+            except Exception as e:
+                print('bilibili token refresh failed:', repr(e))
+                refreshed = False
+            if not refreshed:
+                await asyncio.sleep(REFRESH_RETRY)
@@ -0,0 +1,31 @@
+from typing import BinaryIO, List
+
+from src.utils.ttl_registry import TTLRegistry
+from .spool import close_all
+
+DRAFT_TIMEOUT = 30 * 60  # seconds without input before a draft is dropped
+MAX_DRAFTS = 20
+
+
+class Draft:
+    """the text and images of a dynamic being written"""
+    __slots__ = ('text', 'images')
+
+    def __init__(self):
+        self.text = ''
+        self.images: List[BinaryIO] = []  # see spool.py
+
+    def close(self):
+        """deletes the images, the draft can't be used after"""
+        close_all(self.images)
+        self.images = []
+
+
+class DraftRegistry(TTLRegistry[str, Draft]):
+    """
+    The draft of every user (by qq) writing a dynamic, so several users can write theirs at once, all sent through the
+    one BilibiliClient. A draft dropped for any reason is closed, so its image files go away with it
+    """
+
+    def __init__(self, timeout: float = DRAFT_TIMEOUT, max_drafts: int = MAX_DRAFTS):
+        super().__init__('bilibili drafts', timeout, max_drafts, on_drop=Draft.close)
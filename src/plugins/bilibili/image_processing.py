@@ -0,0 +1,124 @@
+"""
+Shrinks the received images before they're uploaded: phone photos come in at full resolution with their EXIF.
+
+An image bigger than the budget (IMAGE_MAX_SIDE pixels on its longest side, or IMAGE_TARGET_BYTES) is downsized and
+recompressed, one carrying metadata is re-encoded without it, and the smaller of the result and the original is kept.
+Pillow does the CPU work in a small thread pool, so it never runs on the event loop: it releases the GIL while it
+decodes, resizes and encodes. An image taking longer than IMAGE_TIMEOUT is uploaded as it is. Without Pillow images
+stay untouched.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import BinaryIO, List, Optional, Tuple
+
+from .spool import IMAGE_SPOOL_BYTES, image_buffer, buffer_size, reader
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional, the images are uploaded as they are
+    Image = ImageOps = None
+
+IMAGE_MAX_SIDE = 2048  # pixels
+IMAGE_TARGET_BYTES = 2 * 1024 * 1024
+IMAGE_WORKERS = 2  # threads
+IMAGE_TIMEOUT = 30  # seconds for one image
+JPEG_QUALITIES = (85, 75, 65)  # tried in turn until the image fits IMAGE_TARGET_BYTES
+
+
+def shrink_image(source: BinaryIO, size: int, max_side: int = IMAGE_MAX_SIDE,
+                 target_bytes: int = IMAGE_TARGET_BYTES) -> Optional[bytes]:
+    """
+    :return the image of `size` bytes read from `source` recompressed within the budget and without metadata,
+            None to keep it as it is
+    Runs in the worker threads, Pillow reads `source` as it needs it; closes it
+    """
+    with source, Image.open(source) as img:
+        if getattr(img, 'is_animated', False):  # gifs would lose their frames
+            return None
+        has_metadata = bool(img.info.get('exif') or img.info.get('icc_profile') or img.getexif())
+        if size <= target_bytes and max(img.size) <= max_side and not has_metadata:
+            return None
+        img = ImageOps.exif_transpose(img)  # the orientation goes away with the exif, rotate the pixels instead
+        img.thumbnail((max_side, max_side), Image.LANCZOS)  # only ever downsizes
+
+        buffer = BytesIO()
+        if img.mode in ('RGBA', 'LA', 'P'):  # keeps the transparency
+            img.save(buffer, 'PNG', optimize=True)
+        else:
+            img = img.convert('RGB')
+            for quality in JPEG_QUALITIES:
+                buffer = BytesIO()
+                img.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+                if buffer.tell() <= target_bytes:
+                    break
+    shrunk = buffer.getvalue()
+    return shrunk if len(shrunk) < size else None
+
+
+class ImageProcessor:
+    def __init__(self, max_side: int = IMAGE_MAX_SIDE, target_bytes: int = IMAGE_TARGET_BYTES,
+                 workers: int = IMAGE_WORKERS, spool_bytes: int = IMAGE_SPOOL_BYTES, timeout: float = IMAGE_TIMEOUT):
+        self.max_side, self.target_bytes, self.workers = max_side, target_bytes, workers
+        self.spool_bytes, self.timeout = spool_bytes, timeout
+        self._pool: Optional[ThreadPoolExecutor] = None  # started on first use
+        # images being read by a worker, no more than there are workers; made on first use, in the bot's event loop
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    def _executor(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='bilibili-image')
+        return self._pool
+
+    def _done(self, job: asyncio.Future):
+        self._slots.release()  # once the thread is done with the image, even if it was given up on
+        if not job.cancelled():
+            job.exception()  # retrieved, nobody awaits a job that timed out
+
+    async def _shrink(self, img: BinaryIO) -> BinaryIO:
+        await self._slots.acquire()
+        try:
+            # the worker reads its own view of the image, which stays valid if the original is uploaded meanwhile
+            job = asyncio.get_running_loop().run_in_executor(
+                self._executor(), shrink_image, reader(img), buffer_size(img), self.max_side, self.target_bytes)
+        except BaseException:
+            self._slots.release()
+            raise
+        job.add_done_callback(self._done)
+        try:
+            shrunk = await asyncio.wait_for(asyncio.shield(job), self.timeout)
+        except asyncio.TimeoutError:  # the thread finishes it all the same, the result is dropped
+            print(f'image processing took over {self.timeout}s, keeping the original')
+            return img
+        except Exception as e:  # not an image Pillow can read: upload it as it is
+            print('image processing failed, keeping the original:', repr(e))
+            return img
+        if shrunk is None:
+            return img
+        img.close()
+        shrunk_img = image_buffer(self.spool_bytes)
+        shrunk_img.write(shrunk)
+        shrunk_img.seek(0)
+        return shrunk_img
+
+    async def shrink_all(self, images: List[BinaryIO]) -> Tuple[List[BinaryIO], int]:
+        """
+        Shrinks all the images in the pool, as many at a time as there are workers
+        :return the images in the same order, and the bytes saved in total
+        """
+        if not self.available or not images:
+            return images, 0
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        sizes = sum(map(buffer_size, images))
+        shrunk = await asyncio.gather(*map(self._shrink, images))
+        return list(shrunk), sizes - sum(map(buffer_size, shrunk))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -0,0 +1,236 @@
+"""
+Dynamics waiting to be sent, kept in sqlite (bilibili_queue.db) with their images in files next to it, so a restart
+loses none of them. A background dispatcher sends them one at a time through the client, each once its publish time
+comes, at least POST_INTERVAL apart so bilibili doesn't rate limit the account. Every time bilibili says it does
+anyway, the interval is doubled, up to MAX_POST_INTERVAL, until a post goes through. A failed post is retried after
+POST_RETRY seconds, doubled every time, and given up after POST_ATTEMPTS.
+
+A post being sent when the bot stopped is sent again after the restart: it may show up twice, but never goes missing
+"""
+import asyncio
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, BinaryIO, Callable, List, Optional, Tuple
+
+from .BilibiliClient import RateLimited
+
+QUEUE_DB = 'bilibili_queue.db'
+QUEUE_IMAGE_DIR = 'bilibili_queue'
+POST_INTERVAL = 60  # seconds between two posts at least
+MAX_POST_INTERVAL = 60 * 60  # seconds, how far rate limiting can stretch the interval
+POST_ATTEMPTS = 5
+POST_RETRY = 60  # seconds before retrying a failed post, doubled after each failure
+POLL_INTERVAL = 10 * 60  # seconds the dispatcher sleeps at most, it's woken up for every new post anyway
+
+PENDING, SENDING, SENT, FAILED, CANCELLED = 'pending', 'sending', 'sent', 'failed', 'cancelled'
+STATUS_NAMES = {PENDING: '等待发送', SENDING: '发送中', SENT: '已发送', FAILED: '发送失败', CANCELLED: '已撤销'}
+
+
+class QueuedPost:
+    __slots__ = ('id', 'qq', 'text', 'images', 'publish_at', 'status', 'attempts', 'error', 'sent_at')
+    COLUMNS = ', '.join(__slots__)
+
+    def __init__(self, id: int, qq: str, text: str, images: int, publish_at: float, status: str, attempts: int,
+                 error: Optional[str], sent_at: Optional[float]):
+        self.id, self.qq, self.text, self.images = id, qq, text, images  # images: how many
+        self.publish_at, self.status, self.attempts, self.error, self.sent_at = \
+            publish_at, status, attempts, error, sent_at
+
+    def describe(self) -> str:
+        when = time.strftime('%m-%d %H:%M', time.localtime(self.sent_at or self.publish_at))
+        line = f'#{self.id} {STATUS_NAMES[self.status]} {when}，{self.images}张图片，{self.text.strip()[:20]!r}'
+        if self.attempts and self.status != SENT:
+            line += f'，已尝试{self.attempts}次'
+        if self.error and self.status in (PENDING, FAILED):
+            line += f'\n  {self.error[:100]}'
+        return line
+
+
+class PostQueue:
+    """
+    All sqlite calls and image file copies run on a single dedicated thread, like the blackjack database, the public
+    methods are coroutines that await it. Table `bilibili_post`: one row per post, its images are the files
+    `<image_dir>/<post id>_<position>`, deleted once the post is done with
+    """
+
+    def __init__(self, db_path: str = QUEUE_DB, image_dir: str = QUEUE_IMAGE_DIR, interval: float = POST_INTERVAL,
+                 attempts: int = POST_ATTEMPTS, retry: float = POST_RETRY):
+        self.image_dir, self.interval, self.attempts, self.retry = image_dir, interval, attempts, retry
+        os.makedirs(image_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bilibili-queue')
+        self.conn: sqlite3.Connection = self._executor.submit(self._connect, db_path).result()
+        self._wake: Optional[asyncio.Event] = None  # made in the dispatcher, in the bot's event loop
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._pause = interval  # before the next post, grows while bilibili rate limits us
+
+    @staticmethod
+    def _connect(db_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS bilibili_post (id INTEGER PRIMARY KEY AUTOINCREMENT, qq TEXT,
+                        text TEXT, images INTEGER, publish_at REAL, status TEXT, attempts INTEGER, error TEXT,
+                        sent_at REAL, next_try REAL)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS bilibili_post_due ON bilibili_post (status, next_try)''')
+        # interrupted by a restart, see the module doc
+        conn.execute('''UPDATE bilibili_post SET status=? WHERE status=?''', (PENDING, SENDING))
+        conn.commit()
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _image_path(self, post_id: int, position: int) -> str:
+        return os.path.join(self.image_dir, f'{post_id}_{position}')
+
+    def _add(self, qq: str, text: str, images: List[BinaryIO], publish_at: float) -> int:
+        with self.conn:  # if the bot dies while copying, the post was never queued, only its files are left
+            cursor = self.conn.execute('''INSERT INTO bilibili_post (qq, text, images, publish_at, status, attempts,
+                                          next_try) VALUES (?, ?, ?, ?, ?, 0, ?)''',
+                                       (qq, text, len(images), publish_at, PENDING, publish_at))
+            post_id = cursor.lastrowid
+            for position, img in enumerate(images):
+                img.seek(0)
+                with open(self._image_path(post_id, position), 'wb') as fp:
+                    shutil.copyfileobj(img, fp)  # in chunks, the image is never read whole
+                    fp.flush()
+                    os.fsync(fp.fileno())
+        return post_id
+
+    def _delete_images(self, post_id: int, images: int):
+        for position in range(images):
+            try:
+                os.remove(self._image_path(post_id, position))
+            except FileNotFoundError:
+                pass
+
+    def _get(self, query: str, args: tuple) -> List[QueuedPost]:
+        return [QueuedPost(*row) for row in
+                self.conn.execute(f'''SELECT {QueuedPost.COLUMNS} FROM bilibili_post {query}''', args)]
+
+    def _next_due(self) -> Optional[float]:
+        """when the next pending post is due, None if there is none"""
+        row = self.conn.execute('''SELECT min(next_try) FROM bilibili_post WHERE status=?''', (PENDING,)).fetchone()
+        return row[0]
+
+    def _take_due(self, now: float) -> Optional[QueuedPost]:
+        with self.conn:
+            posts = self._get('WHERE status=? AND next_try<=? ORDER BY next_try LIMIT 1', (PENDING, now))
+            if not posts:
+                return None
+            self.conn.execute('''UPDATE bilibili_post SET status=?, attempts=attempts+1 WHERE id=?''',
+                              (SENDING, posts[0].id))
+        posts[0].attempts += 1
+        return posts[0]
+
+    def _finish(self, post: QueuedPost, status: str, error: Optional[str], next_try: Optional[float]):
+        with self.conn:
+            self.conn.execute('''UPDATE bilibili_post SET status=?, error=?, next_try=?, sent_at=? WHERE id=?''',
+                              (status, error, next_try, time.time() if status == SENT else None, post.id))
+        if status != PENDING:
+            self._delete_images(post.id, post.images)
+
+    def _cancel(self, qq: str, post_id: int) -> bool:
+        with self.conn:
+            posts = self._get('WHERE id=? AND qq=? AND status=?', (post_id, qq, PENDING))
+            if not posts:
+                return False
+            self.conn.execute('''UPDATE bilibili_post SET status=? WHERE id=?''', (CANCELLED, post_id))
+        self._delete_images(post_id, posts[0].images)
+        return True
+
+    async def add(self, qq: str, text: str, images: List[BinaryIO], publish_at: Optional[float] = None) -> int:
+        """queues a post, to be sent at `publish_at` (a timestamp) or as soon as possible; :returns its id"""
+        post_id = await self._run(self._add, qq, text, images, publish_at or time.time())
+        if self._wake is not None:
+            self._wake.set()
+        return post_id
+
+    async def cancel(self, qq: str, post_id: int) -> bool:
+        """cancels a post of `qq` not sent yet, :returns whether there was one"""
+        return await self._run(self._cancel, qq, post_id)
+
+    async def posts_of(self, qq: str, limit: int = 10) -> List[QueuedPost]:
+        """the posts of `qq` still to send and the latest ones done, the most recent first"""
+        return await self._run(self._get, '''WHERE qq=? ORDER BY status IN (?, ?) DESC, id DESC LIMIT ?''',
+                               (qq, PENDING, SENDING, limit))
+
+    async def _send(self, client, post: QueuedPost) -> Tuple[Optional[str], bool]:
+        """:returns why it failed, None if sent, and whether bilibili rate limited it"""
+        images = []
+        try:
+            images = [open(self._image_path(post.id, position), 'rb') for position in range(post.images)]
+            await client.send_dynamic(post.text, images)
+        except Exception as e:
+            return str(e) or repr(e), isinstance(e, RateLimited)
+        finally:
+            for img in images:
+                img.close()
+        return None, False
+
+    async def _dispatch_one(self, client, notify: Callable[[QueuedPost], Awaitable]):
+        """sends the next post due, or waits for one"""
+        post = await self._run(self._take_due, time.time())
+        if post is None:
+            due = await self._run(self._next_due)
+            delay = POLL_INTERVAL if due is None else min(max(due - time.time(), 0), POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        error, rate_limited = await self._send(client, post)
+        if rate_limited:
+            self._pause = min(self._pause * 2, max(MAX_POST_INTERVAL, self.interval))
+            print(f'bilibili rate limited the posts, {self._pause}s between them now')
+        elif error is None:
+            self._pause = self.interval
+        if error is None:
+            post.status, post.error = SENT, None
+            await self._run(self._finish, post, SENT, None, None)
+        elif post.attempts < self.attempts:
+            post.status, post.error = PENDING, error
+            next_try = time.time() + max(self.retry * 2 ** (post.attempts - 1), self._pause if rate_limited else 0)
+            print(f'bilibili post #{post.id} failed, retrying at {time.ctime(next_try)}:', error)
+            await self._run(self._finish, post, PENDING, error, next_try)
+        else:
+            post.status, post.error = FAILED, error
+            await self._run(self._finish, post, FAILED, error, None)
+        if post.status != PENDING:
+            try:
+                await notify(post)
+            except Exception as e:  # the post is done with all the same
+                print('bilibili post notification failed:', repr(e))
+        await asyncio.sleep(self._pause)  # pacing, whatever the outcome
+
+    async def _dispatch(self, client, notify: Callable[[QueuedPost], Awaitable]):
+        self._wake = asyncio.Event()
+        failures = 0  # in a row, of the queue itself: the db or the image files
+        while True:
+            try:
+                await self._dispatch_one(client, notify)
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # a post taken when it failed is sent again after a restart
+                delay = min(self.retry * 2 ** failures, POLL_INTERVAL)
+                failures += 1
+                print(f'bilibili queue failed, trying again in {delay}s:', repr(e))
+                await asyncio.sleep(delay)
+
+    def start(self, client, notify: Callable[[QueuedPost], Awaitable]):
+        """starts sending the queued posts with `client`, `notify` is awaited with every post sent or given up"""
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.ensure_future(self._dispatch(client, notify))
+
+    async def stop(self):
+        """stops sending, closes the connection on the queue thread once its pending work is done, then the thread"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        await self._run(self.conn.close)
+        self._executor.shutdown()  # idle by now, returns at once
@@ -0,0 +1,106 @@
+"""
+Buffers holding the images of a dynamic: in memory while small, moved to a temp file past IMAGE_SPOOL_BYTES,
+so the plugin's memory doesn't grow with the size or number of the images it holds.
+"""
+import io
+import os
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Iterable
+
+IMAGE_SPOOL_BYTES = 512 * 1024
+
+
+def image_buffer(spool_bytes: int = IMAGE_SPOOL_BYTES) -> BinaryIO:
+    return SpooledTemporaryFile(max_size=spool_bytes)
+
+
+def buffer_size(buffer: BinaryIO) -> int:
+    position = buffer.tell()
+    size = buffer.seek(0, os.SEEK_END)
+    buffer.seek(position)
+    return size
+
+
+class _PositionalReader(io.RawIOBase):
+    """reads a file descriptor at its own position with os.pread, the position shared by its duplicates never moves"""
+
+    def __init__(self, fd: int):
+        self._fd, self._position = fd, 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = os.pread(self._fd, len(b), self._position)
+        memoryview(b)[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self._fd).st_size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
+def reader(buffer: BinaryIO) -> BinaryIO:
+    """
+    Reads what `buffer` holds with a position of its own, for a thread to read while `buffer` is read meanwhile, or
+    closed. A buffer moved to its temp file is read through a duplicate of its descriptor, one still in memory is copied
+    (no more than IMAGE_SPOOL_BYTES then). Close it after.
+    """
+    in_memory = isinstance(buffer, SpooledTemporaryFile) and not buffer._rolled  # fileno() would move it to disk
+    if hasattr(os, 'pread') and not in_memory:
+        try:
+            buffer.flush()
+            fd = os.dup(buffer.fileno())
+        except (AttributeError, io.UnsupportedOperation):
+            pass
+        else:
+            return io.BufferedReader(_PositionalReader(fd))
+    position = buffer.tell()
+    buffer.seek(0)
+    copy = io.BytesIO(buffer.read())
+    buffer.seek(position)
+    return copy
+
+
+class Uploadable:
+    """
+    `buffer` with only read, seek and tell: httpx gets the length of a file to upload from its fileno() when it has one,
+    which moves a SpooledTemporaryFile still in memory to disk
+    """
+    __slots__ = ('_buffer',)
+
+    def __init__(self, buffer: BinaryIO):
+        self._buffer = buffer
+
+    def read(self, size: int = -1) -> bytes:
+        return self._buffer.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._buffer.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._buffer.tell()
+
+
+def close_all(buffers: Iterable[BinaryIO]):
+    """deletes the temp files now instead of whenever they're collected"""
+    for buffer in buffers:
+        buffer.close()
@@ -0,0 +1,32 @@
+import asyncio
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# one thread for every save: they run in the order they were made, so an older save can't replace a newer one
+_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bilibili-storage')
+
+
+def write_atomic(path: str, data: str):
+    """
+    writes a temp file next to `path` then swaps it in, so `path` is never left half written; every write has a temp
+    file of its own, concurrent ones can't mix
+    """
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+async def save_atomic(path: str, data: str):
+    """write_atomic on the storage thread, after every save made before it"""
+    await asyncio.get_running_loop().run_in_executor(_WRITER, write_atomic, path, data)
@@ -0,0 +1,113 @@
+"""
+Remembers what bilibili answered for every image uploaded, by content hash, so a repost of the same image reuses the
+image_url instead of uploading it again.
+
+The entries are kept in LRU order, at most `max_entries` of them, and expire after `ttl` seconds in case bilibili
+drops old images. They're saved to a json file, written to a temp file then swapped in, so a crash can't corrupt it,
+and read at startup in a thread (`load`).
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from .storage import save_atomic
+
+UPLOAD_CACHE_FILE = 'bilibili_upload_cache.json'
+UPLOAD_CACHE_SIZE = 2000  # entries
+UPLOAD_CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+HASH_CHUNK = 1 << 20
+
+
+def _hash(img: BinaryIO) -> str:
+    img.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: img.read(HASH_CHUNK), b''):
+        digest.update(chunk)
+    img.seek(0)
+    return digest.hexdigest()
+
+
+async def content_hash(img: BinaryIO) -> str:
+    """sha256 of the whole image, in a thread since big images take a while"""
+    return await asyncio.get_running_loop().run_in_executor(None, _hash, img)
+
+
+class UploadCache:
+    def __init__(self, path: str = UPLOAD_CACHE_FILE, max_entries: int = UPLOAD_CACHE_SIZE,
+                 ttl: float = UPLOAD_CACHE_TTL):
+        self.path, self.max_entries, self.ttl = path, max_entries, ttl
+        # hash -> (when it was uploaded, the upload response data), least recently used first
+        self._entries: 'OrderedDict[str, Tuple[float, Dict]]' = OrderedDict()
+        self._loaded = False
+        self._dirty = False
+        self.hits = self.misses = 0  # since launch
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self.path, 'r') as fp:
+                entries = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print('upload cache unreadable, starting empty:', repr(e))
+            return
+        # saved in LRU order, so whatever was read just now is only more recent
+        for key, (stored_at, info) in entries:
+            self._entries.setdefault(key, (stored_at, info))
+
+    async def load(self):
+        """reads the file in a thread, so the event loop doesn't wait on the disk nor the json parsing"""
+        if not self._loaded:
+            await asyncio.get_running_loop().run_in_executor(None, self._load)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """the upload response data of the image hashed `key`, None if it was never uploaded or it expired"""
+        if not self._loaded:
+            self._load()
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl:
+            del self._entries[key]
+            self._dirty = True
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        self._dirty = True
+        return entry[1]
+
+    def put(self, key: str, info: Dict):
+        if not self._loaded:
+            self._load()
+        self._entries[key] = (time.time(), info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    async def save(self):
+        """writes the cache to its file if it changed, in a thread"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        data = json.dumps(list(self._entries.items()))  # here, while nothing else can change the entries
+        try:
+            await save_atomic(self.path, data)
+        except OSError as e:
+            self._dirty = True
+            print('upload cache not saved:', repr(e))
+
+    def stats(self) -> str:
+        if not self._loaded:
+            self._load()
+        looked_up = self.hits + self.misses
+        rate = f'，命中率{self.hits / looked_up:.0%}' if looked_up else ''
+        return f'图片缓存：{len(self._entries)}/{self.max_entries}条，启动以来命中{self.hits}次，未命中{self.misses}次{rate}'
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,26 +1,123 @@
-from nonebot.rule import to_me
+from functools import partial
+from datetime import timedelta
+from typing import Type, Dict, Optional
+import logging
+import re
+import time
+from nonebot.matcher import Matcher
+from nonebot.rule import to_me, Rule
+from nonebot.permission import SUPERUSER
 from nonebot.typing import T_State
 from nonebot.adapters.cqhttp import Bot, Event, MessageSegment, Message, MessageEvent
-from nonebot import on_regex, on_message
+from nonebot import on_regex, on_message, get_driver
+from nonebot.log import LoguruHandler
+import asyncio
 from random import randint, random
-from .blackjack_game import Blackjack, GameMessage
+from .blackjack_game import Blackjack, GameMessage, Shoe, Strategy, SHOE_PENETRATION, auto_play
 from .database import DB
+from .session import SESSIONS, SessionKey, SESSION_TIMEOUT
+from .throttle import Throttle
+from .table import Table, TABLES, TABLE_ACTIONS, TABLE_ACTION_TIMEOUT, TABLE_OPEN_TIMEOUT, DEALER_STANDS_ON, table_of
+from . import advisor
 
 DEFAULT_BET = 100
+LEADERBOARD_SIZE = 5  # players shown at each end of the leaderboard
+AUTO_PLAY_MAX_HANDS = 100
+AUTO_PLAY_STAND_ON = 17
 
-game = on_regex(r'^\[CQ:at.+?\] *打牌')
+driver = get_driver()
+# how long a game's matcher waits for the player's next move, SESSION_EXPIRE_TIMEOUT in .env; a second more since its
+# own deadline starts a bit later. A game kept longer in SESSIONS is picked up by `resume` afterwards
+MATCHER_TIMEOUT = getattr(driver.config, 'session_expire_timeout', timedelta(minutes=2))
+MATCHER_TIMEOUT = (MATCHER_TIMEOUT.total_seconds() if isinstance(MATCHER_TIMEOUT, timedelta)
+                   else float(MATCHER_TIMEOUT)) + 1
+# the engine logs through the standard logging module, shown with the bot's own log
+engine_logger = logging.getLogger('blackjack')
+engine_logger.addHandler(LoguruHandler())
+engine_logger.setLevel(logging.INFO)
 
 
-async def handle_message(msg: GameMessage):
-    """handle the message received from game accordingly"""
+def throttle_from_config(name: str, rate: float, burst: float) -> Throttle:
+    """a Throttle whose rate (requests per second) and burst can be set as BLACKJACK_<NAME>_RATE/_BURST in .env"""
+    return Throttle(float(getattr(driver.config, f'blackjack_{name}_rate', rate)),
+                    float(getattr(driver.config, f'blackjack_{name}_burst', burst)))
+
+
+# starting games and robbing, per player and per group
+game_user_throttle = throttle_from_config('game_user', 1 / 10, 3)
+game_group_throttle = throttle_from_config('game_group', 1, 10)
+rob_user_throttle = throttle_from_config('rob_user', 1 / 300, 1)
+rob_group_throttle = throttle_from_config('rob_group', 1 / 10, 3)
+
+
+# decks in the shoe each group deals from, 0 for a fresh deck every game; BLACKJACK_SHOE_DECKS in .env
+SHOE_DECKS = int(getattr(driver.config, 'blackjack_shoe_decks', 0))
+# share of the shoe dealt before reshuffling, BLACKJACK_SHOE_PENETRATION in .env
+SHOE_CUT = float(getattr(driver.config, 'blackjack_shoe_penetration', SHOE_PENETRATION))
+SHOES: Dict[str, Shoe] = {}  # group id -> its shoe, made on the group's first game
+
+
+def group_shoe(group_id: str) -> Optional[Shoe]:
+    """the shoe a new game of the group deals from if shoes are enabled, None in private chat"""
+    if not SHOE_DECKS or not group_id:
+        return None
+    shoe = SHOES[group_id] = SHOES[group_id].next_shoe() if group_id in SHOES else Shoe(SHOE_DECKS, SHOE_CUT)
+    return shoe
+
+
+async def enforce_throttle(matcher: Type[Matcher], event: MessageEvent, user_throttle: Throttle,
+                           group_throttle: Throttle, warning: str):
+    """
+    finishes `matcher` if the sender or their group went over the limit, call it before anything touches the db
+    only the first refused request is answered with `warning`, the next ones are ignored silently
+    """
+    group_id = str(getattr(event, 'group_id', '') or '')
+    for throttle, key in ((user_throttle, event.get_user_id()), (group_throttle, group_id)):
+        if key and not throttle.acquire(key):
+            await matcher.finish(warning if throttle.should_warn(key) else None)
+
+
+@driver.on_startup
+async def start_database():
+    DB.start(SESSION_TIMEOUT)  # timed write-behind flush of the balance cache, and pruning of abandoned games
+    SESSIONS.start()  # drops games abandoned by their players
+    # the precomputed advice for opening hands, see build_blackjack_advice.py
+    hands = await asyncio.get_running_loop().run_in_executor(None, advisor.load_opening_advice)
+    if hands is None:
+        print('no blackjack opening advice table, advice is computed when asked')
+
+
+@driver.on_shutdown
+async def close_database():
+    SESSIONS.stop()
+    await DB.close()  # flushes the balances still in memory
+
+
+game = on_regex(r'^\[CQ:at.+?\] *打牌(?! *[xX×] *\d)')  # "打牌 xN" is auto_play_games
+
+
+def session_key(event: MessageEvent) -> SessionKey:
+    """games are kept per group (none for private chat) and player"""
+    return str(getattr(event, 'group_id', '') or ''), event.get_user_id()
+
+
+async def handle_message(msg: GameMessage, key: SessionKey, game_obj: Blackjack, matcher: Type[Matcher] = game):
+    """handle the message received from game accordingly, and keeps the game's snapshot in sync"""
+    if msg.bot_action == msg.BOT_FINISH:
+        SESSIONS.close(key)
+        await DB.delete_session(key)
+    else:
+        await DB.save_session(key, game_obj.dealer_qq, game_obj.snapshot())
+        SESSIONS.wait(key, MATCHER_TIMEOUT)  # every other action leaves `matcher` waiting for the next move
+
     if msg.bot_action == msg.BOT_SEND:
-        await game.send(msg.response)
+        await matcher.send(msg.response)
     elif msg.bot_action == msg.BOT_REJECT:
-        await game.reject(msg.response)
+        await matcher.reject(msg.response)
     elif msg.bot_action == msg.BOT_FINISH:
-        await game.finish(msg.response)
+        await matcher.finish(msg.response)
     elif msg.bot_action == msg.BOT_PAUSE:
-        await game.pause(msg.response)
+        await matcher.pause(msg.response)
     else:
         raise RuntimeError(f'should never happen, got unexpected {msg.bot_action}')
 
@@ -28,6 +125,7 @@ async def handle_message(msg: GameMessage):
 @game.handle()
 async def first_receive(bot: Bot, event: MessageEvent, state: T_State):
     """First time getting a match from qq message"""
+    await enforce_throttle(game, event, game_user_throttle, game_group_throttle, '打牌太频繁了，歇一会儿吧')
 
     msg: Message = event.get_message()
     player_qq: str = event.get_user_id()
@@ -39,11 +137,16 @@ async def first_receive(bot: Bot, event: MessageEvent, state: T_State):
     if player_qq == dealer_qq:
         await game.finish('禁止左右互搏')
 
-    # create a new Blackjack obj for this game session
-    game_obj = Blackjack(DEFAULT_BET, player_qq, dealer_qq)
-    state['game'] = game_obj
-    message = game_obj.game_start()
-    await handle_message(message)
+    key = session_key(event)
+    if table_of(player_qq, key[0]):
+        await game.finish('你还在牌桌上，先把这桌打完')
+
+    # create a new Blackjack obj for this game session, the session manager holds it rather than the matcher state
+    game_obj = Blackjack(DEFAULT_BET, player_qq, dealer_qq, shoe=group_shoe(key[0]))
+    if not SESSIONS.open(key, game_obj):
+        await game.finish('现在打牌的人太多了，稍后再来吧')
+    message = await game_obj.game_start()
+    await handle_message(message, key, game_obj)
 
 
 @game.receive()
@@ -54,9 +157,200 @@ async def game_loop(bot: Bot, event: MessageEvent, state: T_State):
     """
 
     player_input = str(event.get_message())
-    game_obj: Blackjack = state['game']
-    message = game_obj.receive_input(player_input)
-    await handle_message(message)
+    key = session_key(event)
+    game_obj = SESSIONS.get(key)
+    if game_obj is None:
+        await DB.delete_session(key)
+        await game.finish('太久没有行动，这局已经作废了')
+    message = await game_obj.receive_input(player_input)
+    await handle_message(message, key, game_obj)
+
+
+def has_unattended_game() -> Rule:
+    """
+    a game action from a player whose game no matcher waits for: still in SESSIONS after its matcher expired, or only
+    saved in the db (i.e. the bot restarted since)
+    """
+    actions = {action for phase_actions in Blackjack.PHASE_ACTIONS.values() for action in phase_actions}
+
+    async def _unattended_game(bot: Bot, event: Event, state: T_State) -> bool:
+        if event.get_type() != 'message' or str(event.get_message()).strip() not in actions:
+            return False
+        key = session_key(event)
+        if key in SESSIONS:
+            return not SESSIONS.waited_on(key)
+        return await DB.has_session(key)
+    return Rule(_unattended_game)
+
+
+resume = on_message(rule=has_unattended_game())
+
+
+@resume.handle()
+async def resume_game(bot: Bot, event: MessageEvent, state: T_State):
+    """takes over a game on the player's next action, restoring it if it was only saved, then runs it like game_loop"""
+    key = session_key(event)
+    game_obj = SESSIONS.get(key)
+    if game_obj is None:
+        saved = await DB.load_session(key)
+        if saved is None:
+            await resume.finish()
+        dealer_qq, snapshot, updated = saved
+        try:
+            game_obj = await Blackjack.restore(snapshot, key[1], dealer_qq)
+        except ValueError as e:
+            print('dropping unreadable blackjack snapshot', key, e)
+            game_obj = None
+        if game_obj is None or time.time() - updated > SESSION_TIMEOUT:
+            await DB.delete_session(key)
+            await resume.finish()
+        if not SESSIONS.open(key, game_obj):
+            await resume.finish('现在打牌的人太多了，稍后再来吧')
+        print('blackjack game restored', key)
+
+    message = await game_obj.receive_input(str(event.get_message()))
+    await handle_message(message, key, game_obj, resume)
+
+
+async def in_single_game(event: MessageEvent) -> bool:
+    """whether the sender has a one-on-one game going (or saved) in this group, they can't sit at a table meanwhile"""
+    key = session_key(event)
+    return key in SESSIONS or await DB.has_session(key)
+
+
+def table_rule(phase: Table.Phase, seated: bool, actions=None) -> Rule:
+    """messages in a group whose table is in `phase`, from a seated player if `seated`, one of `actions` if given"""
+
+    async def _table(bot: Bot, event: Event, state: T_State) -> bool:
+        if event.get_type() != 'message' or not getattr(event, 'group_id', None):
+            return False
+        table = TABLES.get(str(event.group_id))
+        if table is None or table.phase != phase or seated and event.get_user_id() not in table:
+            return False
+        return actions is None or str(event.get_message()).strip() in actions
+    return Rule(_table)
+
+
+async def send_to_table(bot: Bot, table: Table, message: str):
+    await bot.send_group_msg(group_id=int(table.group_id), message=message)
+
+
+def close_idle_table(bot: Bot, table: Table):
+    async def close():
+        if TABLES.get(table.group_id) is table and table.phase == Table.Phase.OPEN:
+            del TABLES[table.group_id]
+            await send_to_table(bot, table, '牌桌太久没人开始，散了吧')
+    return close
+
+
+def time_up(bot: Bot, table: Table):
+    async def settle():
+        if table.phase == Table.Phase.PLAYING:
+            results = await table.settle()
+            TABLES.pop(table.group_id, None)
+            await send_to_table(bot, table, '时间到，没行动的自动停牌\n' + results)
+    return settle
+
+
+open_table = on_regex(r'^\[CQ:at.+?\] *开桌')
+
+
+@open_table.handle()
+async def create_table(bot: Bot, event: MessageEvent, state: T_State):
+    """'@dealer 开桌' opens a table in the group with the sender in the first seat, others join with 加入"""
+    await enforce_throttle(open_table, event, game_user_throttle, game_group_throttle, '打牌太频繁了，歇一会儿吧')
+    group_id = str(getattr(event, 'group_id', '') or '')
+    if not group_id:
+        await open_table.finish('只能在群里开桌')
+    player_qq: str = event.get_user_id()
+    dealer_qq: str = event.get_message()[0].data['qq']
+    if player_qq == dealer_qq:
+        await open_table.finish('禁止左右互搏')
+    if await in_single_game(event):
+        await open_table.finish('你还有一局没打完')
+    if group_id in TABLES:
+        await open_table.finish('这个群已经有一桌了，发送 “加入” 入座')
+
+    table = TABLES[group_id] = Table(group_id, dealer_qq, DEFAULT_BET, next_shoe=partial(group_shoe, group_id))
+    table.start_timer(TABLE_OPEN_TIMEOUT, close_idle_table(bot, table))
+    await open_table.finish(table.join(player_qq))
+
+
+join_table = on_regex('^ *加入 *$', rule=table_rule(Table.Phase.OPEN, seated=False))
+
+
+@join_table.handle()
+async def take_seat(bot: Bot, event: MessageEvent, state: T_State):
+    if await in_single_game(event):
+        await join_table.finish('你还有一局没打完')
+    table = TABLES.get(str(event.group_id))
+    if table is None:
+        await join_table.finish()
+    await join_table.finish(table.join(event.get_user_id()))
+
+
+start_table = on_regex('^ *开始 *$', rule=table_rule(Table.Phase.OPEN, seated=True))
+
+
+@start_table.handle()
+async def deal_table(bot: Bot, event: MessageEvent, state: T_State):
+    table = TABLES.get(str(event.group_id))
+    if table is None or table.phase != Table.Phase.OPEN:
+        await start_table.finish()
+    response = table.deal()
+    if table.all_done:  # only blackjacks, nothing to play
+        response += '\n' + await table.settle()
+        TABLES.pop(table.group_id, None)
+    else:
+        table.start_timer(TABLE_ACTION_TIMEOUT, time_up(bot, table))
+    await start_table.finish(response)
+
+
+table_action = on_message(rule=table_rule(Table.Phase.PLAYING, seated=True, actions=TABLE_ACTIONS))
+
+
+@table_action.handle()
+async def play_at_table(bot: Bot, event: MessageEvent, state: T_State):
+    table = TABLES.get(str(event.group_id))
+    response = table.act(event.get_user_id(), str(event.get_message()).strip()) if table is not None else None
+    if response is None:  # done already, or the round just ended
+        await table_action.finish()
+    if table.all_done:
+        response += '\n所有人行动完毕\n' + await table.settle()
+        TABLES.pop(table.group_id, None)
+    await table_action.finish(response)
+
+
+AUTO_PLAY_PATTERN = re.compile(r'^\[CQ:at.+?\] *打牌 *[xX×] *(\d+)(?: *停 *(\d+))?')
+auto_games = on_regex(AUTO_PLAY_PATTERN.pattern)
+
+
+@auto_games.handle()
+async def auto_play_games(bot: Bot, event: MessageEvent, state: T_State):
+    """'@dealer 打牌 xN 停X' plays N hands at once, hitting below X, and settles them in one ledger write"""
+    await enforce_throttle(auto_games, event, game_user_throttle, game_group_throttle, '打牌太频繁了，歇一会儿吧')
+    player_qq: str = event.get_user_id()
+    dealer_qq: str = event.get_message()[0].data['qq']
+    if player_qq == dealer_qq:
+        await auto_games.finish('禁止左右互搏')
+    hands_str, stand_on_str = AUTO_PLAY_PATTERN.search(str(event.get_message())).groups()
+    hands = int(hands_str)
+    stand_on = int(stand_on_str) if stand_on_str else AUTO_PLAY_STAND_ON
+    if not 1 <= hands <= AUTO_PLAY_MAX_HANDS:
+        await auto_games.finish(f'一次最多自动打{AUTO_PLAY_MAX_HANDS}局')
+    if not 2 <= stand_on <= 21:
+        await auto_games.finish('停牌点数要在2到21之间')
+
+    group_id = session_key(event)[0]
+    outcomes, net, player_money, dealer_money = await auto_play(hands, DEFAULT_BET, player_qq, dealer_qq,
+                                                                Strategy(stand_on),
+                                                                next_shoe=partial(group_shoe, group_id))
+    names = {'blackjack': '黑杰克', 'charlie': '五小龙', 'dealer_bust': '对手爆牌', 'bust': '爆牌', 'lose': '输',
+             'push': '平局', 'insurance': '保险赔付'}
+    details = '，'.join(f'{names.get(outcome, outcome)}{count}局' for outcome, count in outcomes.items())
+    result = f'净赚{net}' if net >= 0 else f'净亏{-net}'
+    await auto_games.finish(f'自动打了{hands}局（点数小于{stand_on}就要牌）\n{details}\n'
+                            f'{result}，你的余额：{player_money}，对手余额：{dealer_money}')
 
 
 help_msg = on_regex('帮助', rule=to_me())
@@ -66,7 +360,55 @@ help_msg = on_regex('帮助', rule=to_me())
 async def print_help(bot: Bot, event: MessageEvent, state: T_State):
     await help_msg.finish('21点帮助：\n发送 “@某人 打牌” 即可发起对战。\n'
                           '然后根据bot提示选择行动，例如：要牌，停牌，双倍；按照基础21点规则。\n'
-                          '打牌没有时间间隔限制，也没有金钱限制，甚至可以@黑咕咕 抢钱')
+                          '不知道怎么打可以发送 “建议”，会给出期望收益最高的行动。\n'
+                          '发送 “@某人 打牌 x20 停17” 自动打20局，点数小于17就要牌。\n'
+                          '发送 “@某人 开桌” 让他坐庄，最多5人发送 “加入” 一起打，“开始” 发牌，大家同时行动；'
+                          f'牌桌上没有保险，只有头两张牌可以双倍，庄家不到{DEALER_STANDS_ON}点就要牌。\n'
+                          '@bot 发送 “排行” 查看富豪榜和穷鬼榜，以及自己的排名；发送 “战绩” 查看自己的战绩。\n'
+                          '打牌不能太频繁，但没有金钱限制，甚至可以@黑咕咕 抢钱（几分钟一次）')
+
+
+session_stats = on_regex('^对局统计$', rule=to_me(), permission=SUPERUSER)
+
+
+@session_stats.handle()
+async def print_session_stats(bot: Bot, event: MessageEvent, state: T_State):
+    stats = SESSIONS.stats()
+    await session_stats.finish(f"进行中的21点对局：{stats['sessions']}，涉及{stats['groups']}个群\n"
+                               f"估计占用内存：{stats['memory_bytes'] / 1024:.1f}KB")
+
+
+ranking = on_regex('^ *排行 *$', rule=to_me())
+
+
+@ranking.handle()
+async def print_ranking(bot: Bot, event: MessageEvent, state: T_State):
+    board = await DB.leaderboard()
+    if not len(board):
+        await ranking.finish('还没有人打过牌')
+    richest = '\n'.join(f'{i}. {qq}：{money}' for i, (qq, money) in enumerate(board.top(LEADERBOARD_SIZE), 1))
+    poorest = '\n'.join(f'{i}. {qq}：{money}' for i, (qq, money) in enumerate(board.bottom(LEADERBOARD_SIZE), 1))
+    response = f'富豪榜：\n{richest}\n穷鬼榜：\n{poorest}\n'
+    rank = board.rank(event.get_user_id())
+    if rank is None:
+        response += '你还没有打过牌'
+    else:
+        response += f'你排在第{rank}名，共{len(board)}人'
+    await ranking.finish(response)
+
+
+record = on_regex('^ *战绩 *$', rule=to_me())
+
+
+@record.handle()
+async def print_record(bot: Bot, event: MessageEvent, state: T_State):
+    stats = await DB.get_stats(event.get_user_id())
+    if stats is None:
+        await record.finish('你还没有打过牌')
+    win_rate = stats['wins'] / stats['hands'] if stats['hands'] else 0
+    await record.finish(f"你一共打了{stats['hands']}局，胜率{win_rate:.1%}\n"
+                        f"净赚{stats['net']}，单局最多赢了{stats['biggest_win']}\n"
+                        f"抢钱{stats['robs']}次，净得{stats['rob_net']}")
 
 
 rob = on_regex(' *抢钱 *', rule=to_me())
@@ -74,8 +416,9 @@ rob = on_regex(' *抢钱 *', rule=to_me())
 
 @rob.handle()
 async def robbed(bot: Bot, event: MessageEvent, state: T_State):
+    await enforce_throttle(rob, event, rob_user_throttle, rob_group_throttle, '抢得太勤了，黑咕咕已经报警了，过会儿再来')
     qq = event.get_user_id()
-    original_money = DB.get_money(qq)
+    original_money = await DB.get_money(qq)
     if original_money is None:
         await rob.finish('刚见面就抢，这合理吗')
     elif original_money >= 200:
@@ -83,10 +426,12 @@ async def robbed(bot: Bot, event: MessageEvent, state: T_State):
     if random() < 0.8:
         amount = randint(1, 5) * 100
         total = original_money + amount
-        DB.set_money(qq, total)
+        await DB.set_money(qq, total)
+        await DB.record_rob(qq, 'robbed', amount)
         await rob.finish(f'你抢了黑咕咕{amount}，你的余额{total}，黑咕咕很伤心')
     else:
         amount = randint(1, 5) * 100
         total = original_money - amount
-        DB.set_money(qq, total)
+        await DB.set_money(qq, total)
+        await DB.record_rob(qq, 'robbed_back', -amount)
         await rob.finish(f'黑咕咕心情不好决定倒打一耙，抢了你{amount}，你的余额{total}，黑咕咕心满意足了')
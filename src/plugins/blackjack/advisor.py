@@ -0,0 +1,215 @@
+"""
+EV-optimal play advice for `Blackjack`, by dynamic programming over the cards the player hasn't seen.
+
+Cards are grouped by value (A, 2-9, 10/J/Q/K), a deck composition is the tuple of how many of each value are unseen,
+the dealer's hole card included since the player can't see it. The dealer follows `Blackjack._dealer_hit`:
+draw until beating the player or reaching 21, on a tie draw again with some chance, so a tie is worth 0.
+
+Every table is memoized in bounded LRU caches, keyed by hand and composition; the same situation comes up again and
+again. The advice for the ~550 opening hands of a fresh deck is computed once (build_opening_advice, it takes a while)
+and shipped in OPENING_ADVICE_FILE, so most advice is a lookup from the start instead of after a warm-up on every boot.
+Cards are passed by blackjack value (A is 1), like blackjack_game.CARD_VALUES.
+"""
+import json
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+VALUE_COUNT = 10  # A, 2-9, 10
+FULL_COMPOSITION = (4, 4, 4, 4, 4, 4, 4, 4, 4, 16)
+TEN = VALUE_COUNT - 1  # index of the 10-valued cards
+ADVICE_CACHE_SIZE = 4096
+DP_CACHE_SIZE = 1 << 16  # per table, about 40MB in total when full
+
+OPENING_ADVICE_FILE = os.path.join(os.path.dirname(__file__), 'opening_advice.json')
+OPENING_INSURANCE_COST = 0.5  # the tables are for even bets, see Blackjack._advice
+
+HIT, DOUBLE, STAND = '要牌', '双倍', '停牌'
+INSURE, NO_INSURANCE = '是', '否'
+
+
+def _total(hard: int, has_ace: bool) -> int:
+    """same as Hand.total"""
+    return hard + 10 if has_ace and hard + 10 <= 21 else hard
+
+
+def _without(composition: Tuple[int, ...], index: int) -> Tuple[int, ...]:
+    return composition[:index] + (composition[index] - 1,) + composition[index + 1:]
+
+
+def unseen_composition(seen_values: List[int], composition: Tuple[int, ...] = FULL_COMPOSITION) -> Tuple[int, ...]:
+    """the deck composition left after taking out the cards of `seen_values`"""
+    counts = list(composition)
+    for value in seen_values:
+        counts[value - 1] -= 1
+    return tuple(counts)
+
+
+def shoe_composition(decks: int) -> Tuple[int, ...]:
+    """the composition of a full shoe of `decks` decks"""
+    return tuple(decks * count for count in FULL_COMPOSITION)
+
+
+def _tie_hit_chance(dealer_total: int) -> float:
+    """chance that the dealer draws rather than accepting a tie, see Blackjack._dealer_hit"""
+    if dealer_total < 16:
+        return 0.8
+    elif dealer_total <= 18:
+        return 0.5
+    return 0.2
+
+
+@lru_cache(maxsize=DP_CACHE_SIZE)
+def _dealer_ev(dealer_hard: int, dealer_ace: bool, player_total: int, composition: Tuple[int, ...]) -> float:
+    """player's EV, in bets, once the dealer holds this hand and starts drawing against `player_total`"""
+    dealer_total = _total(dealer_hard, dealer_ace)
+    if dealer_total > 21:
+        return 1.0
+    if dealer_total > player_total:
+        return -1.0
+    if dealer_total == 21:  # both 21
+        return 0.0
+
+    remaining = sum(composition)
+    hit_ev = 0.0
+    for index, count in enumerate(composition):
+        if count:
+            hit_ev += count / remaining * _dealer_ev(dealer_hard + index + 1, dealer_ace or index == 0,
+                                                     player_total, _without(composition, index))
+    if dealer_total == player_total:
+        return _tie_hit_chance(dealer_total) * hit_ev  # accepting the tie is worth 0
+    return hit_ev
+
+
+def _hole_chances(composition: Tuple[int, ...], hole_not_ten: bool) -> List[Tuple[int, float]]:
+    """(index, chance) of the dealer's hole card, it's any unseen card, or any non-10 if the dealer has no blackjack"""
+    allowed = [count if not (hole_not_ten and index == TEN) else 0 for index, count in enumerate(composition)]
+    total = sum(allowed)
+    return [(index, count / total) for index, count in enumerate(allowed) if count]
+
+
+def _next_card_chances(composition: Tuple[int, ...], hole_not_ten: bool) -> List[Tuple[int, float]]:
+    """(index, chance) of the next card the player draws, given that the hole card is one of the unseen"""
+    remaining = sum(composition)
+    if not hole_not_ten:
+        return [(index, count / remaining) for index, count in enumerate(composition) if count]
+    # the hole card is a uniformly random non-10, the next card is any of the other unseen cards
+    not_ten = remaining - composition[TEN]
+    chances = []
+    for index, count in enumerate(composition):
+        hole_share = count / not_ten if index != TEN else 0.0
+        chance = (count - hole_share) / (remaining - 1)
+        if chance > 0:
+            chances.append((index, chance))
+    return chances
+
+
+@lru_cache(maxsize=DP_CACHE_SIZE)
+def _stand_ev(player_total: int, player_count: int, dealer_up: int, composition: Tuple[int, ...],
+              hole_not_ten: bool) -> float:
+    ev = 0.0
+    for hole, chance in _hole_chances(composition, hole_not_ten):
+        dealer_hard, dealer_ace = dealer_up + hole + 2, dealer_up == 0 or hole == 0
+        if player_count >= 5:  # 5-card Charlie, double win unless the dealer has blackjack
+            ev += chance * (-1.0 if _total(dealer_hard, dealer_ace) == 21 else 2.0)
+        else:
+            ev += chance * _dealer_ev(dealer_hard, dealer_ace, player_total, _without(composition, hole))
+    return ev
+
+
+@lru_cache(maxsize=DP_CACHE_SIZE)
+def _action_evs(player_hard: int, player_ace: bool, player_count: int, dealer_up: int,
+                composition: Tuple[int, ...], hole_not_ten: bool) -> Dict[str, float]:
+    """
+    EV of each action for the current bet, in bets, playing optimally afterwards
+    `player_count` is capped at 5, more cards make no difference (Charlie rule) and would only grow the cache
+    """
+    stand = _stand_ev(_total(player_hard, player_ace), player_count, dealer_up, composition, hole_not_ten)
+    hit = double = 0.0
+    for index, chance in _next_card_chances(composition, hole_not_ten):
+        hard = player_hard + index + 1
+        if hard > 21:
+            hit -= chance
+            double -= chance
+            continue
+        after = _without(composition, index)
+        count = min(player_count + 1, 5)
+        hit += chance * max(_action_evs(hard, player_ace or index == 0, count, dealer_up, after, hole_not_ten).values())
+        double += chance * _stand_ev(_total(hard, player_ace or index == 0), count, dealer_up, after, hole_not_ten)
+    return {HIT: hit, DOUBLE: 2 * double, STAND: stand}
+
+
+@lru_cache(maxsize=ADVICE_CACHE_SIZE)
+def _advise(player_hard: int, player_ace: bool, player_count: int, dealer_up: int, composition: Tuple[int, ...],
+            insurance_phase: bool, insurance_cost: float) -> Dict[str, float]:
+    if not insurance_phase:
+        return _action_evs(player_hard, player_ace, player_count, dealer_up, composition, False)
+    # insured: dealer blackjack wins the bet, otherwise pay for it and play on knowing the hole card isn't a 10
+    blackjack_chance = composition[TEN] / sum(composition)
+    play_on = max(_action_evs(player_hard, player_ace, player_count, dealer_up, composition, True).values())
+    insure = blackjack_chance + (1 - blackjack_chance) * (play_on - insurance_cost)
+    no_insurance = max(_action_evs(player_hard, player_ace, player_count, dealer_up, composition, False).values())
+    return {INSURE: insure, NO_INSURANCE: no_insurance}
+
+
+def advise(player_values: List[int], dealer_up_value: int, composition: Tuple[int, ...],
+           insurance_phase: bool = False, insurance_cost: float = 0.5) -> Dict[str, float]:
+    """
+    :param player_values: values of the player's cards
+    :param dealer_up_value: value of the dealer's visible card
+    :param composition: the cards the player hasn't seen, see unseen_composition
+    :param insurance_phase: advise on taking insurance (是/否) instead of the play
+    :param insurance_cost: insurance price as a fraction of the bet
+    :return: player input -> EV of choosing it, in bets, the best first
+    """
+    key = (sum(player_values), 1 in player_values, min(len(player_values), 5), dealer_up_value - 1, composition,
+           insurance_phase, insurance_cost)
+    evs = _opening_advice.get(key) or _advise(*key)
+    return dict(sorted(evs.items(), key=lambda item: item[1], reverse=True))
+
+
+# _advise arguments -> its result, for the opening hands of a fresh deck, see load_opening_advice
+_opening_advice: Dict[tuple, Dict[str, float]] = {}
+
+
+def _opening_keys() -> List[tuple]:
+    keys = []
+    for first in range(1, VALUE_COUNT + 1):
+        for second in range(first, VALUE_COUNT + 1):
+            for dealer_up in range(1, VALUE_COUNT + 1):
+                composition = unseen_composition([first, second, dealer_up])
+                if min(composition) < 0 or first + second == 11 and 1 in (first, second):
+                    continue  # no such deal, or a blackjack which ends the game right away
+                for insurance_phase in (False, True) if dealer_up == 1 else (False,):
+                    keys.append((first + second, 1 in (first, second), 2, dealer_up - 1, composition,
+                                 insurance_phase, OPENING_INSURANCE_COST))
+    return keys
+
+
+def build_opening_advice(path: str = OPENING_ADVICE_FILE) -> int:
+    """
+    computes the advice for every opening hand against every dealer up card of a fresh deck and saves it,
+    :returns how many hands; run it again after changing the house rules
+    """
+    table = [list(key) + [_advise(*key)] for key in _opening_keys()]
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(table, fp, ensure_ascii=False, separators=(',', ':'))
+    return len(table)
+
+
+def load_opening_advice(path: str = OPENING_ADVICE_FILE) -> Optional[int]:
+    """reads the table saved by build_opening_advice, :returns how many hands it has, None if there is no table"""
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            table = json.load(fp)
+    except FileNotFoundError:
+        return None
+    for *key, evs in table:
+        key[4] = tuple(key[4])  # the composition
+        _opening_advice[tuple(key)] = evs
+    return len(table)
+
+
+def main():
+    hands = build_opening_advice()
+    print('opening advice of', hands, 'hands saved to', OPENING_ADVICE_FILE)
@@ -1,13 +1,28 @@
-from typing import List, Dict, Tuple
+import asyncio
+import logging
+import struct
+from typing import Callable, List, Dict, Tuple, Optional
 from itertools import product
-from random import choice, random
-import re
+from random import Random, getrandbits
 from enum import Enum
-from .database import DB
+from .database import DB, BlackjackDatabase, TallyLedger
+from .advisor import advise, unseen_composition, shoe_composition, FULL_COMPOSITION
 
 NEW_PLAYER_MONEY = 500
 
-# NOTE: ALL set_money must be done after get_money, since the stored field values may be outdated by other sessions
+# the engine's debug output (seeds, balances), the plugin shows it in the bot's log; simulations leave it unconfigured
+logger = logging.getLogger('blackjack')
+
+SHOE_PENETRATION = 0.75  # share of a shoe dealt before it's reshuffled
+SHOE_RESERVE = 30  # a shoe is also reshuffled before a game once fewer cards are left, so a game never runs out
+
+SNAPSHOT_VERSION = 3
+# version, game phase (0 if none), doubled, bet, insurance paid, seed, shoe seed, shoe decks (0 if the game has its own
+# deck), position of the game's first card, deck position;
+# followed by the player's card count and cards, then the dealer's cards, one byte each
+SNAPSHOT_HEADER = struct.Struct('<BBBIIQQBHH')
+
+# NOTE: money moving between players must go through DB.transfer, the stored field values may be outdated by other sessions
 
 
 class GameMessage:
@@ -21,129 +36,271 @@ class GameMessage:
         self.bot_action, self.response = bot_response_action, response
 
 
-class Blackjack:
-    card_suit = ['红桃', '黑桃', '方块', '梅花']
-    card_rank = list(range(2, 11)) + ['J', 'Q', 'K', 'A']
-    cards: List[str] = list(map(lambda t: str(t[0]) + str(t[1]), product(card_suit, card_rank)))
+CARD_SUIT = ['红桃', '黑桃', '方块', '梅花']
+CARD_RANK = list(range(2, 11)) + ['J', 'Q', 'K', 'A']
+# a card is an int 0-51, indexing into these tables; the order is the same as product(CARD_SUIT, CARD_RANK)
+CARD_NAMES: List[str] = list(map(lambda t: str(t[0]) + str(t[1]), product(CARD_SUIT, CARD_RANK)))
+# blackjack value of each card, A is 1 here and Hand counts it as 11 when that doesn't bust
+RANK_VALUES: List[int] = list(range(2, 11)) + [10, 10, 10, 1]
+CARD_VALUES: List[int] = [RANK_VALUES[rank] for _ in CARD_SUIT for rank in range(len(CARD_RANK))]
+ACE_VALUE = 1
+
+
+def card_names(cards: List[int]) -> List[str]:
+    """renders cards to their Chinese names, i.e. [0, 51] -> ["红桃2", "梅花A"]"""
+    return [CARD_NAMES[card] for card in cards]
+
+
+def dealer_rng(seed: int) -> Random:
+    """rng of the dealer's tie decisions for the game of `seed`, independent of the shuffle"""
+    return Random(f'{seed}/dealer')
+
+
+class Hand:
+    """cards held by one side, the total is kept up to date as cards are added instead of re-summing the hand"""
+    __slots__ = ('cards', 'hard_total', 'has_ace')
+
+    def __init__(self):
+        self.cards = bytearray()  # one byte per card
+        self.hard_total = 0  # every A counted as 1
+        self.has_ace = False
+
+    def add(self, card: int):
+        self.cards.append(card)
+        value = CARD_VALUES[card]
+        self.hard_total += value
+        if value == ACE_VALUE:
+            self.has_ace = True
+
+    @property
+    def total(self) -> int:
+        """sum of cards under blackjack rules, one A counts as 11 if that doesn't bust (more than one never can)"""
+        if self.has_ace and self.hard_total + 10 <= 21:
+            return self.hard_total + 10
+        return self.hard_total
+
+    def names(self) -> List[str]:
+        return card_names(self.cards)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __getitem__(self, index: int) -> int:
+        return self.cards[index]
+
+
+class Deck:
+    """a deck shuffled once up front, drawing a card just advances an index"""
+    __slots__ = ('cards', 'position')
+
+    def __init__(self, rng: Random):
+        cards = list(range(len(CARD_NAMES)))
+        rng.shuffle(cards)
+        self.cards = bytes(cards)  # one byte per card, immutable once shuffled
+        self.position = 0  # index of the next card to draw
+
+    def draw(self) -> int:
+        card = self.cards[self.position]
+        self.position += 1
+        return card
+
+    def __len__(self):
+        """number of cards left"""
+        return len(self.cards) - self.position
+
+
+class Shoe:
+    """
+    `decks` decks shuffled together and dealt game after game (i.e. all the games of a group), like at a real table,
+    replaced by a new shuffle between games once `penetration` of it is dealt; every shuffle has its own seed, which
+    rebuilds the shoe
+    """
+    __slots__ = ('decks', 'penetration', 'seed', 'cards', 'position')
+
+    def __init__(self, decks: int, penetration: float = SHOE_PENETRATION, seed: Optional[int] = None):
+        self.decks, self.penetration = decks, penetration
+        self.shuffle(seed)
 
-    player_hand: List[str] = []  # cards in player's hand
-    dealer_hand: List[str] = []
+    def shuffle(self, seed: Optional[int] = None):
+        self.seed = seed if seed is not None else getrandbits(64)
+        cards = list(range(len(CARD_NAMES))) * self.decks
+        Random(self.seed).shuffle(cards)
+        self.cards = bytes(cards)
+        self.position = 0
+
+    def extend_to(self, size: int):
+        """
+        adds more shuffled decks at the end until the shoe holds `size` cards, only needed if the games of a group
+        running at once draw past the reserve; the seed still rebuilds them, and the cards already dealt stay valid
+        """
+        while len(self.cards) < size:
+            cards = list(range(len(CARD_NAMES))) * self.decks
+            Random(f'{self.seed}/{len(self.cards)}').shuffle(cards)
+            self.cards += bytes(cards)
+
+    @property
+    def needs_shuffle(self) -> bool:
+        return self.position >= self.penetration * len(self.cards) or len(self) < SHOE_RESERVE
+
+    def next_shoe(self) -> 'Shoe':
+        """
+        this shoe, or a newly shuffled one if it's due; never reshuffled in place, games still in progress keep
+        dealing from (and counting the seen cards of) the shoe they started with
+        """
+        return Shoe(self.decks, self.penetration) if self.needs_shuffle else self
+
+    def draw(self) -> int:
+        if self.position >= len(self.cards):
+            logger.info('blackjack shoe ran out, extended')
+            self.extend_to(self.position + 1)
+        card = self.cards[self.position]
+        self.position += 1
+        return card
+
+    def __len__(self):
+        """number of cards left"""
+        return len(self.cards) - self.position
+
+
+class Blackjack:
+    """
+    One game in progress. Thousands can be alive at once, so the state is kept small:
+    slots instead of a __dict__, cards as bytes, and every table (card names, values, actions) shared at module/class level
+    """
+    __slots__ = ('bet', 'player_qq', 'dealer_qq', 'ledger', 'seed', 'deck', 'first_card', 'player_hand', 'dealer_hand',
+                 'game_phase', 'doubled', 'insured', 'insurance', 'total_money_player', 'total_money_dealer')
 
     class GamePhase(Enum):
         """describing the game phase/state"""
         PLAYER_ACTION = 1
         INSURANCE = 2
 
-    game_phase: GamePhase = None  # used to validate player actions etc.
-
     # this defines the available actions for the player at each game phase
     PHASE_ACTIONS: Dict[GamePhase, List[str]] = {
-        GamePhase.INSURANCE: ['是', '否'],
-        GamePhase.PLAYER_ACTION: ['要牌', '双倍', '停牌']
+        GamePhase.INSURANCE: ['是', '否', '建议'],
+        GamePhase.PLAYER_ACTION: ['要牌', '双倍', '停牌', '建议']
     }
 
-    def __init__(self, bet: int, player_qq: str, dealer_qq: str):
-        """:param bet: the amount of bet for this game"""
+    def __init__(self, bet: int, player_qq: str, dealer_qq: str, seed: Optional[int] = None,
+                 ledger: BlackjackDatabase = DB, shoe: Optional[Shoe] = None):
+        """
+        :param bet: the amount of bet for this game
+        :param seed: seeds all randomness of this game (shuffle and dealer's choices, see dealer_rng), the same seed and
+        the same player inputs replay the exact same game; a random one is picked if not given
+        :param ledger: where the money is kept, the simulator passes a MemoryLedger to leave the db alone
+        :param shoe: deal from this shared shoe instead of a fresh deck shuffled by `seed`, see Shoe.next_shoe
+        """
         self.bet, self.player_qq, self.dealer_qq = bet, player_qq, dealer_qq
+        self.ledger = ledger
 
-        self.card_suit = ['红桃', '黑桃', '方块', '梅花']
-        self.card_rank = list(range(2, 11)) + ['J', 'Q', 'K', 'A']
-        self.cards: List[str] = list(map(lambda t: str(t[0]) + str(t[1]), product(self.card_suit, self.card_rank)))
-        self.player_hand, self.dealer_hand = [], []
-
-        self.total_money_player = DB.get_money(self.player_qq)
-        self.total_money_dealer = DB.get_money(self.dealer_qq)
+        self.seed = seed if seed is not None else getrandbits(64)
+        if shoe is None:
+            # the shuffle's rng isn't kept, its 2.5KB state would be most of the game's memory
+            self.deck = Deck(Random(self.seed))
+        else:
+            self.deck = shoe
+        self.first_card = self.deck.position  # cards dealt before are seen ones when dealing from a shoe
+        self.player_hand, self.dealer_hand = Hand(), Hand()  # cards in player's/dealer's hand
+        self.game_phase: Optional[Blackjack.GamePhase] = None  # used to validate player actions etc.
+        self.doubled = False
+        self.insured = False  # the player took insurance, whether the dealer had blackjack or not
+        self.insurance = 0  # paid for insurance the dealer didn't need, counted in the hand's history
+        self.total_money_player, self.total_money_dealer = None, None
+
+    async def _load_money(self):
+        """reads both balances from the ledger, creating records for new users"""
+        self.total_money_player = await self.ledger.get_money(self.player_qq)
+        self.total_money_dealer = await self.ledger.get_money(self.dealer_qq)
         if self.total_money_player is None:
             # no record for player_qq
-            DB.insert_new(self.player_qq, NEW_PLAYER_MONEY)
+            await self.ledger.insert_new(self.player_qq, NEW_PLAYER_MONEY)
             self.total_money_player = NEW_PLAYER_MONEY
         if self.total_money_dealer is None:
             # no record for dealer_qq
-            DB.insert_new(self.dealer_qq, NEW_PLAYER_MONEY)
+            await self.ledger.insert_new(self.dealer_qq, NEW_PLAYER_MONEY)
             self.total_money_dealer = NEW_PLAYER_MONEY
-        print('player money b4', self.total_money_player, 'dealer money b4', self.total_money_dealer)
-
-    @staticmethod
-    def _cards_sum(cards: List) -> int:
-        """calculates sum of cards under blackjack rules"""
-
-        def get_ranks_list(card_list: List) -> List[str]:
-            """extract a list of ranks (i.e. [10, Q]) from cards list (i.e. "梅花10", "黑桃Q")"""
-            pattern = re.compile('..(\d+|[JQKA])')
-            return list(map(lambda card: pattern.findall(card)[0], card_list))
-
-        def to_number(rank) -> int:
-            if rank in ['J', 'Q', 'K']:
-                return 10
-            elif rank == 'A':
-                # returns 11 always, functions that use this may change 11 to 1 as per rules
-                return 11
-            else:
-                rank = int(rank)
-                return rank
-
-        ranks_list = get_ranks_list(cards)
-        rank_numbers = list(map(to_number, ranks_list))
-        curr_sum = sum(rank_numbers)
-        if curr_sum > 21:
-            # change 11 to 1, if present
-            for i in range(len(rank_numbers)):
-                if rank_numbers[i] == 11:
-                    rank_numbers[i] = 1
-                    new_sum = sum(rank_numbers)
-                    if new_sum <= 21:
-                        # okay, no need to check for more A cards
-                        return new_sum
-                    # else check for more A cards
-            return sum(rank_numbers)
-        else:  # curr_sum <= 21
-            return curr_sum
+        logger.debug('player money b4 %s dealer money b4 %s', self.total_money_player, self.total_money_dealer)
+
+    def snapshot(self) -> bytes:
+        """compact binary state of the game in progress, the deck isn't stored since its seed rebuilds it"""
+        phase = self.game_phase.value if self.game_phase else 0
+        shoe_seed, decks = (self.deck.seed, self.deck.decks) if isinstance(self.deck, Shoe) else (0, 0)
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, phase, self.doubled, self.bet, self.insurance, self.seed,
+                                      shoe_seed, decks, self.first_card, self.deck.position)
+        return header + bytes([len(self.player_hand)]) + bytes(self.player_hand.cards) + bytes(self.dealer_hand.cards)
+
+    @classmethod
+    async def restore(cls, data: bytes, player_qq: str, dealer_qq: str, ledger: BlackjackDatabase = DB) -> 'Blackjack':
+        """
+        rebuilds a game from `snapshot()`, raises ValueError if it's from an incompatible version
+        a game dealt from a shoe gets its own copy of that shoe, the group's shoe didn't survive the restart anyway
+        """
+        if data[0] != SNAPSHOT_VERSION:
+            raise ValueError(f'unsupported blackjack snapshot version {data[0]}')
+        _, phase, doubled, bet, insurance, seed, shoe_seed, decks, first_card, position = \
+            SNAPSHOT_HEADER.unpack_from(data)
+        game = cls(bet, player_qq, dealer_qq, seed=seed, ledger=ledger,
+                   shoe=Shoe(decks, seed=shoe_seed) if decks else None)
+        game.doubled, game.insurance = bool(doubled), insurance
+        game.insured = insurance > 0  # a game insured against a blackjack ended right away, it's never snapshotted
+        if decks:
+            game.deck.extend_to(position)
+        game.first_card, game.deck.position = first_card, position
+        player_count = data[SNAPSHOT_HEADER.size]
+        player_start = SNAPSHOT_HEADER.size + 1
+        for card in data[player_start:player_start + player_count]:
+            game.player_hand.add(card)
+        for card in data[player_start + player_count:]:
+            game.dealer_hand.add(card)
+        game.game_phase = cls.GamePhase(phase) if phase else None
+        await game._load_money()
+        return game
 
     @staticmethod
     def comma_concat(str_list: List[str]):
         return '，'.join(str_list)
 
-    def game_start(self) -> GameMessage:
+    async def game_start(self) -> GameMessage:
         """
         game start, deal cards, returns Chinese string describing game state and possible actions
         NOTE: DO NOT USE BOT_REJECT IN HERE, THIS SHOULD ONLY BE RUN ONCE, MAIN GAME LOOP IS RIGHT AFTER THIS
         """
-        print("game_start, length of cards is", len(self.cards))
+        await self._load_money()
+        logger.info('game_start, seed is %s', self.seed)
 
         # draw initial cards
-        dealer_card1 = choice(self.cards)
-        self.cards.remove(dealer_card1)
-        dealer_card2 = choice(self.cards)
-        self.cards.remove(dealer_card2)
+        dealer_card1 = self.deck.draw()
+        dealer_card2 = self.deck.draw()
         # dealer_card1 should not be visible to player
-        self.dealer_hand.extend([dealer_card1, dealer_card2])
+        self.dealer_hand.add(dealer_card1)
+        self.dealer_hand.add(dealer_card2)
 
-        player_card1 = choice(self.cards)
-        self.cards.remove(player_card1)
-        player_card2 = choice(self.cards)
-        self.cards.remove(player_card2)
-        self.player_hand.extend([player_card1, player_card2])
+        player_card1 = self.deck.draw()
+        player_card2 = self.deck.draw()
+        self.player_hand.add(player_card1)
+        self.player_hand.add(player_card2)
 
         # check for player blackjack
-        if self._cards_sum(self.player_hand) == 21:
-            game_desc = f"你的手牌：{self.comma_concat(self.player_hand)}\n" \
-                        f"对方手牌：{self.comma_concat(self.dealer_hand)}\n"
-            if self._cards_sum(self.dealer_hand) == 21:  # both got blackjack, a tie
+        if self.player_hand.total == 21:
+            game_desc = f"你的手牌：{self.comma_concat(self.player_hand.names())}\n" \
+                        f"对方手牌：{self.comma_concat(self.dealer_hand.names())}\n"
+            if self.dealer_hand.total == 21:  # both got blackjack, a tie
+                await self._record('push', 0)
                 response = game_desc + "双方黑杰克，平局"
                 return GameMessage(GameMessage.BOT_FINISH, response)
 
             # else win double due to blackjack
             win_amount = self.bet = int(2 * self.bet)
-            self.player_win_DB_transaction()
+            await self.player_win_DB_transaction('blackjack')
 
             response = game_desc + f"黑杰克！你赢得了双倍{win_amount}\n" + \
                                    f"你的余额：{self.total_money_player}，对手余额：{self.total_money_dealer}"
             return GameMessage(GameMessage.BOT_FINISH, response)
 
         # dealer has ace as first (revealed) card, enter insurance phase
-        elif 'A' in self.dealer_hand[0]:
+        elif CARD_VALUES[self.dealer_hand[0]] == ACE_VALUE:
             self.game_phase = self.GamePhase.INSURANCE
-            response = f"你的手牌：{self.comma_concat(self.player_hand)}\n" \
+            response = f"你的手牌：{self.comma_concat(self.player_hand.names())}\n" \
                        f"对手的明牌是A，你可以选择花费{int(self.bet / 2)}保险，\n" \
                        f"可选行动：{self.comma_concat(self.PHASE_ACTIONS[self.game_phase])}"
             return GameMessage(GameMessage.BOT_SEND, response)
@@ -151,12 +308,12 @@ class Blackjack:
         # no blackjack on either side, common situation
         else:
             self.game_phase = self.GamePhase.PLAYER_ACTION
-            response = f"你的手牌：{self.comma_concat(self.player_hand)}\n共计{self._cards_sum(self.player_hand)}点\n" \
-                       f"对手的明牌是{self.dealer_hand[0]}\n" \
+            response = f"你的手牌：{self.comma_concat(self.player_hand.names())}\n共计{self.player_hand.total}点\n" \
+                       f"对手的明牌是{CARD_NAMES[self.dealer_hand[0]]}\n" \
                        f"可选行动：{self.comma_concat(self.PHASE_ACTIONS[self.game_phase])}"
             return GameMessage(GameMessage.BOT_SEND, response)
 
-    def receive_input(self, player_input: str):
+    async def receive_input(self, player_input: str):
         """
         Handles all player inputs, cleans and validates the received input and respond accordingly
         THIS WILL BE CALLED FROM THE MAIN GAME LOOP, SO USE BOT_REJECT AND BOT_FINISH ONLY
@@ -167,6 +324,10 @@ class Blackjack:
         if player_input not in self.PHASE_ACTIONS[self.game_phase]:
             return GameMessage(GameMessage.BOT_REJECT, "请从可选行动中选择一项")
 
+        # ask for advice, doesn't change anything
+        if player_input == "建议":
+            return GameMessage(GameMessage.BOT_REJECT, await self._advice())
+
         common_response = "你的手牌：{0}\n共计{1}点\n" \
                           "对手的手牌：{2}\n" \
                           "可选行动：{3}"
@@ -178,22 +339,21 @@ class Blackjack:
         # handle input for common case
         if self.game_phase == self.GamePhase.PLAYER_ACTION:
             if player_input == "要牌":
-                new_card = choice(self.cards)
-                self.cards.remove(new_card)
-                self.player_hand.append(new_card)
+                new_card = self.deck.draw()
+                self.player_hand.add(new_card)
                 # check for player bust
-                curr_sum = self._cards_sum(self.player_hand)
+                curr_sum = self.player_hand.total
                 if curr_sum <= 21:  # player not bust
-                    response = common_response.format(self.comma_concat(self.player_hand), curr_sum,
-                                                      self.dealer_hand[0],
+                    response = common_response.format(self.comma_concat(self.player_hand.names()), curr_sum,
+                                                      CARD_NAMES[self.dealer_hand[0]],
                                                       self.comma_concat(self.PHASE_ACTIONS[self.game_phase])
                                                       )
                     return GameMessage(GameMessage.BOT_REJECT, response)
                 else:  # player bust
-                    self.dealer_win_DB_transaction()
+                    await self.dealer_win_DB_transaction('bust')
 
-                    response = bust_response.format(self.comma_concat(self.player_hand), curr_sum,
-                                                    self.comma_concat(self.dealer_hand), self._cards_sum(self.dealer_hand),
+                    response = bust_response.format(self.comma_concat(self.player_hand.names()), curr_sum,
+                                                    self.comma_concat(self.dealer_hand.names()), self.dealer_hand.total,
                                                     self.bet, self.total_money_player, self.total_money_dealer
                                                     )
                     return GameMessage(GameMessage.BOT_FINISH, response)
@@ -201,58 +361,55 @@ class Blackjack:
             elif player_input == "双倍":
                 # the bet amount is doubled
                 self.bet *= 2
-                new_card = choice(self.cards)
-                self.cards.remove(new_card)
-                self.player_hand.append(new_card)
-                curr_sum = self._cards_sum(self.player_hand)
+                self.doubled = True
+                new_card = self.deck.draw()
+                self.player_hand.add(new_card)
+                curr_sum = self.player_hand.total
                 if curr_sum <= 21:  # player not bust, dealer's turn to hit
-                    return self._dealer_action(curr_sum)
+                    return await self._dealer_action(curr_sum)
 
                 else:  # player bust
-                    self.dealer_win_DB_transaction()
+                    await self.dealer_win_DB_transaction('bust')
 
-                    response = bust_response.format(self.comma_concat(self.player_hand), curr_sum,
-                                                    self.comma_concat(self.dealer_hand), self._cards_sum(self.dealer_hand),
+                    response = bust_response.format(self.comma_concat(self.player_hand.names()), curr_sum,
+                                                    self.comma_concat(self.dealer_hand.names()), self.dealer_hand.total,
                                                     self.bet, self.total_money_player, self.total_money_dealer
                                                     )
                     return GameMessage(GameMessage.BOT_FINISH, response)
 
             elif player_input == "停牌":
-                curr_sum = self._cards_sum(self.player_hand)
+                curr_sum = self.player_hand.total
                 # dealer's turn to hit
-                return self._dealer_action(curr_sum)
+                return await self._dealer_action(curr_sum)
             else:
                 raise RuntimeError('should never have occurred, maybe mismatch of input handling and possible actions')
 
         # handle input for insurance case
         elif self.game_phase == self.GamePhase.INSURANCE:
             if player_input == "是":
+                self.insured = True
                 # check for dealer blackjack
-                if self._cards_sum(self.dealer_hand) == 21:  # dealer has blackjack
+                if self.dealer_hand.total == 21:  # dealer has blackjack
                     # dealer has blackjack, player wins bet amount
-                    self.player_win_DB_transaction()
-                    response = f"对手有黑杰克！\n对手手牌：{self.comma_concat(self.dealer_hand)}\n" \
+                    await self.player_win_DB_transaction('insurance')
+                    response = f"对手有黑杰克！\n对手手牌：{self.comma_concat(self.dealer_hand.names())}\n" \
                                f"赢了{self.bet}，你的余额：{self.total_money_player}，对手余额：{self.total_money_dealer}"
                     return GameMessage(GameMessage.BOT_FINISH, response)
                 else:  # dealer no blackjack, loses insurance (half of bet)
                     self.game_phase = self.GamePhase.PLAYER_ACTION
-                    insurance = int(self.bet / 2)
-                    self.total_money_player = DB.get_money(self.player_qq)
-                    self.total_money_dealer = DB.get_money(self.dealer_qq)
-                    self.total_money_player -= insurance
-                    self.total_money_dealer += insurance
-                    DB.set_money(self.player_qq, self.total_money_player)
-                    DB.set_money(self.dealer_qq, self.total_money_dealer)
+                    insurance = self.insurance = int(self.bet / 2)
+                    self.total_money_player, self.total_money_dealer = \
+                        await self.ledger.transfer(self.player_qq, self.dealer_qq, insurance)
                     insurance_info = f"对手没有黑杰克，{insurance}白给了\n"
-                    response = common_response.format(self.comma_concat(self.player_hand), self._cards_sum(self.player_hand),
-                                                      self.dealer_hand[0],
+                    response = common_response.format(self.comma_concat(self.player_hand.names()), self.player_hand.total,
+                                                      CARD_NAMES[self.dealer_hand[0]],
                                                       self.comma_concat(self.PHASE_ACTIONS[self.game_phase])
                                                       )
                     return GameMessage(GameMessage.BOT_REJECT, insurance_info + response)
             elif player_input == "否":
                 self.game_phase = self.GamePhase.PLAYER_ACTION
-                response = common_response.format(self.comma_concat(self.player_hand), self._cards_sum(self.player_hand),
-                                                  self.dealer_hand[0],
+                response = common_response.format(self.comma_concat(self.player_hand.names()), self.player_hand.total,
+                                                  CARD_NAMES[self.dealer_hand[0]],
                                                   self.comma_concat(self.PHASE_ACTIONS[self.game_phase])
                                                   )
                 return GameMessage(GameMessage.BOT_REJECT, response)
@@ -261,7 +418,7 @@ class Blackjack:
         else:
             raise RuntimeError('should never have occurred, unknown game phase ' + str(self.game_phase))
 
-    def _dealer_action(self, player_sum) -> GameMessage:
+    async def _dealer_action(self, player_sum) -> GameMessage:
         """Player has finished action, the dealer now draws card to either beat the player, or bust"""
 
         dealer_bust_response = "你的手牌：{0}\n共计{1}点\n" \
@@ -282,65 +439,87 @@ class Blackjack:
 
         # 5-card Charlie rule here, i.e. player wins with 5 cards not bust, unless dealer has blackjack
         if len(self.player_hand) >= 5:
-            dealer_sum = self._cards_sum(self.dealer_hand)
+            dealer_sum = self.dealer_hand.total
             if dealer_sum != 21:  # dealer no blackjack
                 # player wins double automatically, since the precondition is player not bust
                 self.bet *= 2
-                self.player_win_DB_transaction()
-                response = charlie_rule_response.format(self.comma_concat(self.player_hand), self.comma_concat(self.dealer_hand), dealer_sum, self.bet, self.total_money_player, self.total_money_dealer)
+                await self.player_win_DB_transaction('charlie')
+                response = charlie_rule_response.format(self.comma_concat(self.player_hand.names()), self.comma_concat(self.dealer_hand.names()), dealer_sum, self.bet, self.total_money_player, self.total_money_dealer)
                 return GameMessage(GameMessage.BOT_FINISH, response)
             else:  # dealer has blackjack, which is better (the best actually)
-                self.dealer_win_DB_transaction()
-                response = dealer_win_response.format(self.comma_concat(self.player_hand), player_sum, self.comma_concat(self.dealer_hand), dealer_sum,
+                await self.dealer_win_DB_transaction('lose')
+                response = dealer_win_response.format(self.comma_concat(self.player_hand.names()), player_sum, self.comma_concat(self.dealer_hand.names()), dealer_sum,
                                                       self.bet, self.total_money_player, self.total_money_dealer)
                 explanation = "对手有黑杰克，大于你的五小龙\n"
                 return GameMessage(GameMessage.BOT_FINISH, explanation + response)
 
         dealer_sum, drawn_cards = self._dealer_hit(player_sum)  # dealer draw cards
         if dealer_sum > 21:  # dealer bust
-            self.player_win_DB_transaction()
+            await self.player_win_DB_transaction('dealer_bust')
 
-            dealer_drawn = f"对手摸牌：{self.comma_concat(drawn_cards)}\n"
-            response = dealer_bust_response.format(self.comma_concat(self.player_hand), player_sum,
-                                                   self.comma_concat(self.dealer_hand), dealer_sum,
+            dealer_drawn = f"对手摸牌：{self.comma_concat(card_names(drawn_cards))}\n"
+            response = dealer_bust_response.format(self.comma_concat(self.player_hand.names()), player_sum,
+                                                   self.comma_concat(self.dealer_hand.names()), dealer_sum,
                                                    self.bet, self.total_money_player, self.total_money_dealer
                                                    )
             return GameMessage(GameMessage.BOT_FINISH, dealer_drawn + response)
 
         elif dealer_sum == player_sum:
             # a draw, i.e. both got 21 or dealer chose to accept a tie
-            dealer_drawn = f"对手摸牌：{self.comma_concat(drawn_cards)}\n"
-            response = tie_response.format(self.comma_concat(self.player_hand), player_sum,
-                                           self.comma_concat(self.dealer_hand), dealer_sum,
+            await self._record('push', 0)
+            dealer_drawn = f"对手摸牌：{self.comma_concat(card_names(drawn_cards))}\n"
+            response = tie_response.format(self.comma_concat(self.player_hand.names()), player_sum,
+                                           self.comma_concat(self.dealer_hand.names()), dealer_sum,
                                            self.total_money_player, self.total_money_dealer
                                            )
             return GameMessage(GameMessage.BOT_FINISH, dealer_drawn + response)
 
         else:  # both not bust and not a tie, dealer must have higher sum as an invariant of `_dealer_hit()`
-            self.dealer_win_DB_transaction()
+            await self.dealer_win_DB_transaction('lose')
 
-            dealer_drawn = f"对手摸牌：{self.comma_concat(drawn_cards)}\n"
-            response = dealer_win_response.format(self.comma_concat(self.player_hand), player_sum,
-                                                  self.comma_concat(self.dealer_hand), dealer_sum,
+            dealer_drawn = f"对手摸牌：{self.comma_concat(card_names(drawn_cards))}\n"
+            response = dealer_win_response.format(self.comma_concat(self.player_hand.names()), player_sum,
+                                                  self.comma_concat(self.dealer_hand.names()), dealer_sum,
                                                   self.bet, self.total_money_player, self.total_money_dealer
                                                   )
             return GameMessage(GameMessage.BOT_FINISH, dealer_drawn + response)
 
-    def _dealer_hit(self, player_hand_sum) -> Tuple[int, List[str]]:
+    async def _advice(self) -> str:
+        """the EV of each possible action given what the player can see, computed off the event loop if not cached"""
+        player_values = [CARD_VALUES[card] for card in self.player_hand.cards]
+        dealer_up_value = CARD_VALUES[self.dealer_hand[0]]
+        if isinstance(self.deck, Shoe):  # the cards dealt from the shoe before this game were seen too
+            seen_values = [CARD_VALUES[card] for card in self.deck.cards[:self.first_card]]
+            composition = unseen_composition(seen_values + player_values + [dealer_up_value],
+                                             shoe_composition(len(self.deck.cards) // len(CARD_NAMES)))
+        else:
+            composition = unseen_composition(player_values + [dealer_up_value], FULL_COMPOSITION)
+        insurance_phase = self.game_phase == self.GamePhase.INSURANCE
+        loop = asyncio.get_running_loop()
+        evs = await loop.run_in_executor(None, advise, player_values, dealer_up_value, composition,
+                                         insurance_phase, int(self.bet / 2) / self.bet)
+        best = next(iter(evs))
+        if insurance_phase:
+            best = '买保险' if best == '是' else '不买保险'
+        ev_desc = self.comma_concat([f"{action}{ev:+.2f}" for action, ev in evs.items()])
+        return f"建议{best}\n各行动的期望收益（以赌注计）：{ev_desc}\n" \
+               f"可选行动：{self.comma_concat(self.PHASE_ACTIONS[self.game_phase])}"
+
+    def _dealer_hit(self, player_hand_sum) -> Tuple[int, List[int]]:
         """
         Dealer performs hits in order to beat the player's hand, or gets exactly 21,
         has the side effect of adding card to dealer_hand
         :return the final sum of dealer's hand, and the list of cards drawn
         """
 
-        dealer_hand_sum = self._cards_sum(self.dealer_hand)
+        dealer_hand_sum = self.dealer_hand.total
         drawn_cards = []
+        rng = dealer_rng(self.seed)
 
         def draw_a_card():
-            new_card = choice(self.cards)
+            new_card = self.deck.draw()
             drawn_cards.append(new_card)
-            self.cards.remove(new_card)
-            self.dealer_hand.append(new_card)
+            self.dealer_hand.add(new_card)
 
         # even if it's going to be a draw with the player also having 21, no need to draw anymore
         if dealer_hand_sum > player_hand_sum or dealer_hand_sum == 21:
@@ -355,7 +534,7 @@ class Blackjack:
                         return dealer_hand_sum, drawn_cards
 
                     # otherwise, some randomness here
-                    chance = random()
+                    chance = rng.random()
                     accept_tie = False
                     if dealer_hand_sum < 16:
                         # most definitely hit
@@ -378,21 +557,68 @@ class Blackjack:
                 else:  # dealer's hand strictly less than player's, draw a card
                     draw_a_card()
                 # must have drawn a card here, calc new dealer_hand_sum
-                dealer_hand_sum = self._cards_sum(self.dealer_hand)
+                dealer_hand_sum = self.dealer_hand.total
             return dealer_hand_sum, drawn_cards
 
-    def player_win_DB_transaction(self):
-        self.total_money_player = DB.get_money(self.player_qq)
-        self.total_money_dealer = DB.get_money(self.dealer_qq)
-        self.total_money_player += self.bet
-        self.total_money_dealer -= self.bet
-        DB.set_money(self.player_qq, self.total_money_player)
-        DB.set_money(self.dealer_qq, self.total_money_dealer)
-
-    def dealer_win_DB_transaction(self):
-        self.total_money_player = DB.get_money(self.player_qq)
-        self.total_money_dealer = DB.get_money(self.dealer_qq)
-        self.total_money_player -= self.bet
-        self.total_money_dealer += self.bet
-        DB.set_money(self.player_qq, self.total_money_player)
-        DB.set_money(self.dealer_qq, self.total_money_dealer)
\ No newline at end of file
+    async def _record(self, outcome: str, won: int):
+        """logs the settled hand, `won` is what the player got at settlement (the insurance was paid before)"""
+        await self.ledger.record_hand(self.player_qq, self.dealer_qq, self.bet, self.doubled, self.insured,
+                                      outcome, won - self.insurance)
+
+    async def player_win_DB_transaction(self, outcome: str):
+        self.total_money_dealer, self.total_money_player = await self.ledger.transfer(self.dealer_qq, self.player_qq, self.bet)
+        await self._record(outcome, self.bet)
+
+    async def dealer_win_DB_transaction(self, outcome: str):
+        self.total_money_player, self.total_money_dealer = await self.ledger.transfer(self.player_qq, self.dealer_qq, self.bet)
+        await self._record(outcome, -self.bet)
+
+
+class Strategy:
+    """
+    A simple fixed player policy: double on the first action if the total is in `double_on`,
+    hit while below `stand_on` (stops at 5 cards, which wins by the 5-card Charlie rule), then stand
+    """
+
+    def __init__(self, stand_on: int = 17, double_on: Tuple[int, ...] = (), take_insurance: bool = False):
+        self.stand_on, self.double_on, self.take_insurance = stand_on, double_on, take_insurance
+
+    def action(self, game: Blackjack) -> str:
+        """:returns the player input for the current state of `game`"""
+        if game.game_phase == Blackjack.GamePhase.INSURANCE:
+            return '是' if self.take_insurance else '否'
+        total = game.player_hand.total
+        if len(game.player_hand) == 2 and total in self.double_on:
+            return '双倍'
+        if total < self.stand_on and len(game.player_hand) < 5:
+            return '要牌'
+        return '停牌'
+
+    def __str__(self):
+        return f'stand on {self.stand_on}, double on {list(self.double_on)}, insurance {self.take_insurance}'
+
+
+async def auto_play(hands: int, bet: int, player_qq: str, dealer_qq: str, strategy: Strategy,
+                    ledger: BlackjackDatabase = DB, next_shoe: Optional[Callable[[], Optional[Shoe]]] = None
+                    ) -> Tuple[Dict[str, int], int, int, int]:
+    """
+    Plays `hands` games in a row with `strategy` for the player, on a TallyLedger, then settles the net result
+    with one transfer in `ledger`; the hands are logged to its history too
+    :param next_shoe: called before every hand for the shoe to deal it from (i.e. the group's, which it keeps up to
+    date), a fresh deck is dealt without it, or if it gives None
+    :returns (outcome -> number of hands, player's net win, player's balance, dealer's balance)
+    """
+    tally = TallyLedger()
+    await tally.load(ledger, [player_qq, dealer_qq], NEW_PLAYER_MONEY)
+    for _ in range(hands):
+        shoe = next_shoe() if next_shoe is not None else None
+        game = Blackjack(bet, player_qq, dealer_qq, ledger=tally, shoe=shoe)
+        message = await game.game_start()
+        while message.bot_action != message.BOT_FINISH:
+            message = await game.receive_input(strategy.action(game))
+    outcomes: Dict[str, int] = {}
+    for hand in tally.history:
+        outcomes[hand[5]] = outcomes.get(hand[5], 0) + 1
+    net = tally.money[player_qq] - tally.start[player_qq]
+    dealer_money, player_money = await tally.settle(ledger, dealer_qq, player_qq)
+    return outcomes, net, player_money, dealer_money
@@ -1,19 +1,109 @@
+import asyncio
 import sqlite3
-from typing import Optional
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Set, List, Dict
+
+from .leaderboard import Leaderboard
+
+FLUSH_INTERVAL = 2  # seconds between two timed flushes of dirty balances
+FLUSH_THRESHOLD = 200  # flush right away once this many balances are dirty
+CACHE_SIZE = 2000  # max cached balances, only clean entries are evicted
+PRUNE_INTERVAL = 60  # seconds between two deletions of the snapshots of abandoned games
+
+# (group id, '' in private chat; player qq), same as session.SessionKey
+SessionKey = Tuple[str, str]
+
+# per-player aggregates of the history, in blackjack_stats column order after qq; all are sums but biggest_win, a max
+STATS_FIELDS = ('hands', 'wins', 'net', 'biggest_win', 'robs', 'rob_net')
 
 
 class BlackjackDatabase:
     """
     Blackjack game related database operations
-    The db has a table `blackjack`, with columns: `qq` TEXT PRIMARY KEY, `money` REAL
+    The db has a table `blackjack`, with columns: `qq` TEXT PRIMARY KEY, `money` INTEGER
+    and a table `blackjack_session` holding snapshots of games in progress, so they survive a restart
+
+    All sqlite calls run on a single dedicated writer thread, the public methods are coroutines that await it,
+    so a slow disk (commit/fsync) never blocks the event loop, i.e. other plugins and group sessions
+
+    Balances are cached in memory and written behind: changes only mark the entry dirty, dirty entries are
+    written in one batched transaction every FLUSH_INTERVAL seconds (or once FLUSH_THRESHOLD are dirty),
+    and on shutdown. So at most the last FLUSH_INTERVAL seconds of changes can be lost on a crash.
+    Game snapshots are written behind the same way, in the same transaction as the balances, so they always agree
+
+    Every settled hand and rob is appended to `blackjack_history`, and folded into the per-player totals of
+    `blackjack_stats` as it's written (same batched transaction), so a player's record is one row to read
+
+    Rankings come from an in-memory `Leaderboard` of every balance, built from the db on first use (reading the
+    `money` index in order) and then kept up to date by every balance change, so the table is never sorted again
     """
 
-    def __init__(self):
-        self.conn = sqlite3.connect('blackjack.db')
-        self.cursor = self.conn.cursor()
+    def __init__(self, db_path: str = 'blackjack.db'):
+        # one worker thread only, so all db access is serialized and the connection never leaves its thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='blackjack-db')
+        # opened by the first job, importing the plugin (or the simulator, the tests) leaves the db file alone
+        self.db_path = db_path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.cursor: Optional[sqlite3.Cursor] = None
 
-    def get_money(self, qq: str) -> Optional[int]:
-        """:returns The amount of money the user with `qq` has, or None if not present in db"""
+        # qq -> money, least recently used first; the cache is the source of truth for every qq in it
+        self._cache: 'OrderedDict[str, int]' = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._session_timeout: Optional[float] = None  # see start
+
+        # snapshots waiting for the next flush, None means delete; (dealer qq, snapshot, update time)
+        self._pending_sessions: Dict[SessionKey, Optional[Tuple[str, bytes, float]]] = {}
+        self._session_keys: Optional[Set[SessionKey]] = None  # keys of all stored snapshots, loaded on first use
+        # the number of the last change of each snapshot that may still be in flight, numbered across all keys; a failed
+        # flush only puts back the snapshots nothing replaced since, not even one written by a later flush
+        self._session_changes: Dict[SessionKey, int] = {}
+        self._last_session_change = 0
+
+        # history rows and per-player stats increments waiting for the next flush
+        self._pending_history: List[tuple] = []
+        self._pending_stats: Dict[str, List[int]] = {}  # qq -> values in STATS_FIELDS order
+
+        self._leaderboard: Optional[Leaderboard] = None  # set once loading starts, changes are applied from then on
+        self._leaderboard_loading: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def _connect(db_path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(db_path)
+        # WAL lets readers go on during a commit, and with synchronous=NORMAL a commit no longer fsyncs every time
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS blackjack (qq TEXT PRIMARY KEY, money INTEGER)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS blackjack_money ON blackjack (money)''')
+        # net is the player's win, the dealer (the one @'d, or the bot for robs) lost as much
+        conn.execute('''CREATE TABLE IF NOT EXISTS blackjack_history (time REAL, kind TEXT, player_qq TEXT,
+                        dealer_qq TEXT, bet INTEGER, doubled INTEGER, insured INTEGER, outcome TEXT, net INTEGER)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS blackjack_stats (qq TEXT PRIMARY KEY, hands INTEGER, wins INTEGER,
+                        net INTEGER, biggest_win INTEGER, robs INTEGER, rob_net INTEGER)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS blackjack_session (group_id TEXT, player_qq TEXT, dealer_qq TEXT,
+                        state BLOB, updated REAL, PRIMARY KEY (group_id, player_qq))''')
+        conn.commit()
+        return conn
+
+    def _call(self, func, args: tuple):
+        if self.conn is None:
+            self.conn = self._connect(self.db_path)
+            self.cursor = self.conn.cursor()
+        return func(*args)
+
+    async def _run(self, func, *args):
+        """runs `func` on the db thread, connecting first if needed, and waits for it without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = self.cursor = None
+
+    def _get_money(self, qq: str) -> Optional[int]:
         query = '''SELECT money FROM blackjack WHERE qq=?'''
         self.cursor.execute(query, (qq,))
         result = self.cursor.fetchone()
@@ -22,21 +112,368 @@ class BlackjackDatabase:
             money = result[0]
         return money
 
-    def set_money(self, qq: str, amount: int):
-        """Set the money `amount` for the given `qq`"""
-        query = '''UPDATE blackjack SET money=? WHERE qq=?'''
-        self.cursor.execute(query, (amount, qq))
-        self.conn.commit()
+    def _get_all_money(self) -> List[Tuple[str, int]]:
+        self.cursor.execute('''SELECT qq, money FROM blackjack ORDER BY money''')
+        return self.cursor.fetchall()
 
-    def insert_new(self, qq: str, money: int):
+    def _get_stats(self, qq: str) -> Optional[tuple]:
+        self.cursor.execute(f'''SELECT {', '.join(STATS_FIELDS)} FROM blackjack_stats WHERE qq=?''', (qq,))
+        return self.cursor.fetchone()
+
+    def _get_session(self, key: SessionKey) -> Optional[Tuple[str, bytes, float]]:
+        query = '''SELECT dealer_qq, state, updated FROM blackjack_session WHERE group_id=? AND player_qq=?'''
+        self.cursor.execute(query, key)
+        return self.cursor.fetchone()
+
+    def _get_session_keys(self) -> List[SessionKey]:
+        self.cursor.execute('''SELECT group_id, player_qq FROM blackjack_session''')
+        return self.cursor.fetchall()
+
+    def _delete_sessions_before(self, cutoff: float) -> List[SessionKey]:
+        with self.conn:
+            self.cursor.execute('''SELECT group_id, player_qq FROM blackjack_session WHERE updated<?''', (cutoff,))
+            keys = self.cursor.fetchall()
+            self.cursor.execute('''DELETE FROM blackjack_session WHERE updated<?''', (cutoff,))
+        return keys
+
+    def _write(self, balances: List[Tuple[str, int]], sessions: List[tuple], deleted_sessions: List[SessionKey],
+               history: List[tuple], stats: List[tuple]):
+        with self.conn:  # one transaction, one commit for the whole batch
+            self.cursor.executemany('''INSERT INTO blackjack (qq, money) VALUES (?, ?)
+                                       ON CONFLICT(qq) DO UPDATE SET money=excluded.money''', balances)
+            self.cursor.executemany('''INSERT INTO blackjack_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', history)
+            self.cursor.executemany('''INSERT INTO blackjack_stats VALUES (?, ?, ?, ?, ?, ?, ?)
+                                       ON CONFLICT(qq) DO UPDATE SET hands=hands+excluded.hands,
+                                       wins=wins+excluded.wins, net=net+excluded.net,
+                                       biggest_win=max(biggest_win, excluded.biggest_win),
+                                       robs=robs+excluded.robs, rob_net=rob_net+excluded.rob_net''', stats)
+            self.cursor.executemany('''INSERT OR REPLACE INTO blackjack_session VALUES (?, ?, ?, ?, ?)''', sessions)
+            self.cursor.executemany('''DELETE FROM blackjack_session WHERE group_id=? AND player_qq=?''',
+                                    deleted_sessions)
+
+    async def _cached_money(self, qq: str) -> Optional[int]:
+        """returns the balance from cache, loading it from the db on a miss"""
+        if qq in self._cache:
+            self._cache.move_to_end(qq)
+            return self._cache[qq]
+        money = await self._run(self._get_money, qq)
+        if qq in self._cache:
+            # someone else loaded (and maybe changed) it while we were waiting, that one is newer
+            return self._cache[qq]
+        if money is not None:
+            self._cache[qq] = money
+            self._evict()
+        return money
+
+    def _mark_dirty(self, qq: str, money: int):
+        self._cache[qq] = money
+        self._cache.move_to_end(qq)
+        self._dirty.add(qq)
+        if self._leaderboard is not None:
+            self._leaderboard.update(qq, money)
+        if len(self._dirty) >= FLUSH_THRESHOLD:
+            asyncio.ensure_future(self.flush())
+
+    def _add_stats(self, qq: str, increments: List[int]):
+        """merges `increments` (in STATS_FIELDS order) into the pending stats of `qq`"""
+        pending = self._pending_stats.get(qq)
+        if pending is None:
+            self._pending_stats[qq] = list(increments)
+            return
+        for i, (field, value) in enumerate(zip(STATS_FIELDS, increments)):
+            pending[i] = max(pending[i], value) if field == 'biggest_win' else pending[i] + value
+
+    def _append_history(self, row: tuple):
+        self._pending_history.append(row)
+        if len(self._pending_history) >= FLUSH_THRESHOLD:
+            asyncio.ensure_future(self.flush())
+
+    def _evict(self):
+        """drops least recently used clean entries while the cache is too big, dirty ones must stay until flushed"""
+        if len(self._cache) <= CACHE_SIZE:
+            return
+        for qq in list(self._cache):
+            if len(self._cache) <= CACHE_SIZE:
+                break
+            if qq not in self._dirty:
+                del self._cache[qq]
+
+    async def get_money(self, qq: str) -> Optional[int]:
+        """:returns The amount of money the user with `qq` has, or None if not present in db"""
+        return await self._cached_money(qq)
+
+    async def set_money(self, qq: str, amount: int):
+        """Set the money `amount` for the given `qq`, does nothing if the user has no record"""
+        if await self._cached_money(qq) is not None:
+            self._mark_dirty(qq, amount)
+
+    async def insert_new(self, qq: str, money: int):
         """Insert a new record for new user"""
-        query = '''INSERT INTO blackjack VALUES (?, ?)'''
+        if await self._cached_money(qq) is not None:
+            # this should never happen
+            print('insert_new called for existing user', qq)
+            return
+        self._mark_dirty(qq, money)
+
+    async def transfer(self, from_qq: str, to_qq: str, amount: int) -> Tuple[int, int]:
+        """
+        Moves `amount` of money from `from_qq` to `to_qq` atomically, both users must already have a record
+        :returns the new balances of `from_qq` and `to_qq`
+        """
+        await self._cached_money(from_qq)
+        await self._cached_money(to_qq)
+        # no await from here on, so both changes happen together with nothing interleaved
+        from_money, to_money = self._cache[from_qq] - amount, self._cache[to_qq] + amount
+        self._mark_dirty(from_qq, from_money)
+        self._mark_dirty(to_qq, to_money)
+        return from_money, to_money
+
+    async def transfer_many(self, from_qq: str, transfers: List[Tuple[str, int]]) -> Dict[str, int]:
+        """
+        Moves each (qq, amount) from `from_qq` to that qq, a negative amount the other way, all at once:
+        the changes are made together with nothing interleaved, so they're written in the same flush transaction
+        Every user must already have a record
+        :returns the new balances of everyone involved
+        """
+        for qq in [from_qq] + [qq for qq, _ in transfers]:
+            await self._cached_money(qq)
+        # no await from here on
+        balances = {from_qq: self._cache[from_qq]}
+        for qq, amount in transfers:
+            balances[from_qq] -= amount
+            balances[qq] = balances.get(qq, self._cache[qq]) + amount
+        for qq, money in balances.items():
+            self._mark_dirty(qq, money)
+        return balances
+
+    async def record_hand(self, player_qq: str, dealer_qq: str, bet: int, doubled: bool, insured: bool, outcome: str,
+                          net: int):
+        """
+        logs a settled hand and counts it in both players' stats
+        :param bet: the final bet, doubled already if so
+        :param net: what the player won in the end, insurance included, negative if lost
+        """
+        self._append_history((time.time(), 'hand', player_qq, dealer_qq, bet, int(doubled), int(insured), outcome, net))
+        self._add_stats(player_qq, [1, int(net > 0), net, max(net, 0), 0, 0])
+        self._add_stats(dealer_qq, [1, int(net < 0), -net, max(-net, 0), 0, 0])
+
+    async def record_rob(self, qq: str, outcome: str, net: int):
+        """logs a rob of the bot, `net` is what `qq` got out of it"""
+        self._append_history((time.time(), 'rob', qq, '', 0, 0, 0, outcome, net))
+        self._add_stats(qq, [0, 0, 0, 0, 1, net])
+
+    async def get_stats(self, qq: str) -> Optional[Dict[str, int]]:
+        """:returns the totals of `qq` by STATS_FIELDS, or None if `qq` never played nor robbed"""
+        # taken before reading: a flush started meanwhile writes after the read, since the db thread runs jobs in order
+        pending = list(self._pending_stats.get(qq, ())) or None
+        row = await self._run(self._get_stats, qq)
+        stats = dict(zip(STATS_FIELDS, row)) if row else None
+        if pending is not None:  # not flushed yet
+            if stats is None:
+                stats = dict.fromkeys(STATS_FIELDS, 0)
+            for field, value in zip(STATS_FIELDS, pending):
+                stats[field] = max(stats[field], value) if field == 'biggest_win' else stats[field] + value
+        return stats
+
+    async def _load_leaderboard(self) -> Leaderboard:
+        leaderboard = self._leaderboard = Leaderboard()
+        # the cache is the truth for what it holds, and changes made while the db is read go straight to the
+        # leaderboard, so the rows read only fill in players not ranked yet
+        for qq, money in self._cache.items():
+            leaderboard.update(qq, money)
+        try:
+            rows = await self._run(self._get_all_money)
+        except sqlite3.Error:
+            self._leaderboard = self._leaderboard_loading = None
+            raise
+        leaderboard.add_missing(rows)
+        print('blackjack leaderboard loaded', len(leaderboard))
+        return leaderboard
+
+    async def leaderboard(self) -> Leaderboard:
+        """every player's balance in rank order, read from the db the first time only"""
+        if self._leaderboard_loading is None:
+            self._leaderboard_loading = asyncio.ensure_future(self._load_leaderboard())
+        return await asyncio.shield(self._leaderboard_loading)
+
+    def _set_pending_session(self, key: SessionKey, value: Optional[Tuple[str, bytes, float]]):
+        self._pending_sessions[key] = value
+        self._last_session_change += 1
+        self._session_changes[key] = self._last_session_change
+
+    async def save_session(self, key: SessionKey, dealer_qq: str, state: bytes):
+        """stores the snapshot of the game of `key`, replacing the previous one"""
+        self._set_pending_session(key, (dealer_qq, state, time.time()))
+        if self._session_keys is not None:
+            self._session_keys.add(key)
+
+    async def delete_session(self, key: SessionKey):
+        """drops the snapshot of a finished game"""
+        if self._session_keys is None or key in self._session_keys:
+            self._set_pending_session(key, None)
+        if self._session_keys is not None:
+            self._session_keys.discard(key)
+
+    async def has_session(self, key: SessionKey) -> bool:
+        """whether a snapshot is stored for `key`, without reading it"""
+        if self._session_keys is None:
+            keys = set(await self._run(self._get_session_keys))
+            if self._session_keys is None:
+                for pending_key, pending in self._pending_sessions.items():
+                    if pending is None:
+                        keys.discard(pending_key)
+                    else:
+                        keys.add(pending_key)
+                self._session_keys = keys
+        return key in self._session_keys
+
+    async def delete_sessions_before(self, cutoff: float) -> int:
+        """drops the snapshots of games not played since `cutoff` (a time.time()), :returns how many were stored"""
+        for key, pending in list(self._pending_sessions.items()):
+            if pending is not None and pending[2] < cutoff:
+                self._set_pending_session(key, None)
+                if self._session_keys is not None:
+                    self._session_keys.discard(key)
+        keys = await self._run(self._delete_sessions_before, cutoff)
+        if self._session_keys is not None:
+            # a snapshot saved meanwhile is newer, it's written by the next flush
+            self._session_keys.difference_update(key for key in keys if not self._pending_sessions.get(key))
+        return len(keys)
+
+    async def load_session(self, key: SessionKey) -> Optional[Tuple[str, bytes, float]]:
+        """:returns (dealer qq, snapshot, update time as in time.time()) of the game of `key`, or None"""
+        if key in self._pending_sessions:
+            return self._pending_sessions[key]
+        return await self._run(self._get_session, key)
+
+    async def flush(self):
+        """writes all dirty balances and pending snapshots to the db in a single transaction"""
+        if not self._dirty and not self._pending_sessions and not self._pending_history and not self._pending_stats:
+            return
+        # snapshot now, the db thread runs jobs in submission order so an older snapshot never overwrites a newer one
+        balances = [(qq, self._cache[qq]) for qq in self._dirty]
+        pending_sessions = self._pending_sessions
+        changes = {key: self._session_changes[key] for key in pending_sessions}
+        sessions = [key + value for key, value in pending_sessions.items() if value is not None]
+        deleted_sessions = [key for key, value in pending_sessions.items() if value is None]
+        history, pending_stats = self._pending_history, self._pending_stats
+        stats = [(qq,) + tuple(values) for qq, values in pending_stats.items()]
+        self._dirty, self._pending_sessions = set(), {}
+        self._pending_history, self._pending_stats = [], {}
         try:
-            self.cursor.execute(query, (qq, money))
-            self.conn.commit()
+            await self._run(self._write, balances, sessions, deleted_sessions, history, stats)
         except sqlite3.Error as e:
-            # this should never happen
-            print(query, e)
+            # keep them pending so the next flush retries, unless they were changed again meanwhile
+            self._dirty.update(qq for qq, _ in balances)
+            for key, value in pending_sessions.items():
+                if self._session_changes.get(key) == changes[key]:
+                    self._pending_sessions[key] = value
+            self._pending_history[:0] = history
+            for qq, values in pending_stats.items():
+                self._add_stats(qq, values)
+            print('blackjack flush failed', e)
+        else:
+            for key, change in changes.items():
+                if self._session_changes.get(key) == change:  # written, nothing newer to keep track of
+                    del self._session_changes[key]
+        self._evict()
+
+    async def _flush_loop(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+            if self._session_timeout is not None and time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                last_prune = time.monotonic()
+                try:
+                    pruned = await self.delete_sessions_before(time.time() - self._session_timeout)
+                except sqlite3.Error as e:
+                    print('blackjack snapshot pruning failed', e)
+                else:
+                    if pruned:
+                        print('blackjack snapshots of abandoned games deleted', pruned)
+
+    def start(self, session_timeout: Optional[float] = None):
+        """
+        starts the timed flush, call it once the event loop is running
+        :param session_timeout: snapshots not updated for that long are deleted, their games can't be resumed anyway
+        """
+        self._session_timeout = session_timeout
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self):
+        """flushes what is left, closes the connection on the db thread, then stops the thread"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown()
+
+
+class MemoryLedger:
+    """in-memory stand-in for BlackjackDatabase, for games that must not touch blackjack.db (i.e. simulations)"""
+
+    def __init__(self):
+        self.money: Dict[str, int] = {}
+        self.history: List[tuple] = []  # (player qq, dealer qq, bet, doubled, insured, outcome, net) of each hand
+
+    async def get_money(self, qq: str) -> Optional[int]:
+        return self.money.get(qq)
+
+    async def set_money(self, qq: str, amount: int):
+        if qq in self.money:
+            self.money[qq] = amount
+
+    async def insert_new(self, qq: str, money: int):
+        self.money.setdefault(qq, money)
+
+    async def transfer(self, from_qq: str, to_qq: str, amount: int) -> Tuple[int, int]:
+        self.money[from_qq] -= amount
+        self.money[to_qq] += amount
+        return self.money[from_qq], self.money[to_qq]
+
+    async def transfer_many(self, from_qq: str, transfers: List[Tuple[str, int]]) -> Dict[str, int]:
+        for qq, amount in transfers:
+            self.money[from_qq] -= amount
+            self.money[qq] += amount
+        return {qq: self.money[qq] for qq in [from_qq] + [qq for qq, _ in transfers]}
+
+    async def record_hand(self, player_qq: str, dealer_qq: str, bet: int, doubled: bool, insured: bool, outcome: str,
+                          net: int):
+        self.history.append((player_qq, dealer_qq, bet, doubled, insured, outcome, net))
+
+
+class TallyLedger(MemoryLedger):
+    """
+    MemoryLedger starting from the real balances of a few users, to play a batch of games without touching the real
+    ledger; `settle` then moves the net result and logs the hands in one go
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.start: Dict[str, int] = {}  # balances copied by `load`
+
+    async def load(self, ledger: BlackjackDatabase, qqs: List[str], new_player_money: int):
+        """copies the balances of `qqs` from `ledger`, creating records there for new users"""
+        for qq in qqs:
+            money = await ledger.get_money(qq)
+            if money is None:
+                await ledger.insert_new(qq, new_player_money)
+                money = new_player_money
+            self.money[qq] = money
+        self.start = dict(self.money)
+
+    async def settle(self, ledger: BlackjackDatabase, from_qq: str, to_qq: str) -> Tuple[int, int]:
+        """
+        moves what `to_qq` won here from `from_qq` in `ledger` (two users only), with a single transfer
+        :returns the new balances of `from_qq` and `to_qq`
+        """
+        balances = await ledger.transfer(from_qq, to_qq, self.money[to_qq] - self.start[to_qq])
+        for hand in self.history:
+            await ledger.record_hand(*hand)
+        return balances
 
 
 DB = BlackjackDatabase()
@@ -0,0 +1,47 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    """
+    Every player's balance kept sorted, richest first, so ranks and top/bottom lists are O(log n) instead of a full
+    sort of the table. BlackjackDatabase builds it once and updates it on every balance change
+    """
+
+    def __init__(self):
+        self._money: Dict[str, int] = {}  # qq -> the balance it's ranked by
+        self._ranked = SortedList()  # (-money, qq)
+
+    def update(self, qq: str, money: int):
+        old = self._money.get(qq)
+        if old == money:
+            return
+        if old is not None:
+            self._ranked.remove((-old, qq))
+        self._money[qq] = money
+        self._ranked.add((-money, qq))
+
+    def add_missing(self, balances: Iterable[Tuple[str, int]]):
+        """ranks each (qq, money) unless that qq is ranked already (with a newer balance), in one bulk insert"""
+        missing = [(qq, money) for qq, money in balances if qq not in self._money]
+        self._money.update(missing)
+        self._ranked.update((-money, qq) for qq, money in missing)
+
+    def rank(self, qq: str) -> Optional[int]:
+        """1 for the richest, players with the same balance share a rank; None if `qq` has no record"""
+        money = self._money.get(qq)
+        if money is None:
+            return None
+        return self._ranked.bisect_left((-money,)) + 1
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        """(qq, money) of the `n` richest players, richest first"""
+        return [(qq, -negated) for negated, qq in self._ranked.islice(0, n)]
+
+    def bottom(self, n: int) -> List[Tuple[str, int]]:
+        """(qq, money) of the `n` poorest players, poorest first"""
+        return [(qq, -negated) for negated, qq in self._ranked.islice(max(len(self._ranked) - n, 0), reverse=True)]
+
+    def __len__(self):
+        return len(self._ranked)
@@ -0,0 +1,53 @@
+"""
+Measures the memory taken by games in progress with tracemalloc, to size the host for a number of concurrent players.
+
+Every game is dealt (so its hands hold cards) and registered in a `SessionManager`, like a player waiting to act.
+Balances live in a `MemoryLedger` filled before measuring: the real ledger caches them apart from the games.
+"""
+import argparse
+import asyncio
+import gc
+import tracemalloc
+from typing import List
+
+from .blackjack_game import Blackjack
+from .database import MemoryLedger
+from .session import SessionManager
+
+DEFAULT_COUNTS = [1_000, 10_000, 100_000]
+
+
+async def _open_games(games: int, ledger: MemoryLedger, player_qqs: List[str], manager: SessionManager):
+    for player_qq in player_qqs:
+        game = Blackjack(100, player_qq, 'dealer', ledger=ledger)
+        await game.game_start()
+        manager.open(('benchmark', player_qq), game)
+
+
+def measure(games: int) -> float:
+    """:returns bytes allocated per game in progress, with `games` of them open at once"""
+    player_qqs = [str(10_000_000 + i) for i in range(games)]  # the qq strings come with the events, not the games
+    ledger = MemoryLedger()
+    ledger.money = dict.fromkeys(player_qqs + ['dealer'], 1 << 40)
+    manager = SessionManager(max_sessions=games)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        asyncio.run(_open_games(games, ledger, player_qqs, manager))
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert len(manager) == games
+    return used / games
+
+
+def main():
+    parser = argparse.ArgumentParser(description='memory used per concurrent blackjack game')
+    parser.add_argument('counts', type=int, nargs='*', default=DEFAULT_COUNTS, help='numbers of concurrent games')
+    args = parser.parse_args()
+
+    for games in args.counts:
+        per_game = measure(games)
+        print(f'{games:>9,} games: {per_game:,.0f} bytes per game, {per_game * games / 2 ** 20:,.1f} MiB in total')
@@ -0,0 +1,81 @@
+import sys
+import time
+from enum import Enum
+from typing import Dict, Tuple
+
+from src.utils.ttl_registry import TTLRegistry
+from .blackjack_game import Blackjack
+
+SESSION_TIMEOUT = 10 * 60  # seconds without player input before a game is dropped
+MAX_SESSIONS = 2000
+MEMORY_SAMPLE = 50  # sessions measured for the memory estimate
+
+# (group id, '' in private chat; player qq)
+SessionKey = Tuple[str, str]
+
+
+def _deep_size(obj, seen: set) -> int:
+    """bytes used by `obj` and everything it owns, skipping what's shared between games (classes, the ledger, etc.)"""
+    if id(obj) in seen or isinstance(obj, (type, Enum)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(key, seen) + _deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        attributes = dict(vars(obj))
+        attributes.pop('ledger', None)
+        size += _deep_size(attributes, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        if slot != 'ledger' and hasattr(obj, slot):
+            size += _deep_size(getattr(obj, slot), seen)
+    return size
+
+
+class SessionManager(TTLRegistry[SessionKey, Blackjack]):
+    """
+    Keeps every game in progress, by group and player, instead of leaving them in matcher state forever.
+    Games idle for longer than `timeout` are dropped, and no more than `max_sessions` can run at once.
+    A game outlives the matcher waiting for its player's next move (see `wait`), another one picks it up after that
+    """
+
+    def __init__(self, timeout: float = SESSION_TIMEOUT, max_sessions: int = MAX_SESSIONS):
+        super().__init__('blackjack sessions', timeout, max_sessions)
+        self._waiting: Dict[SessionKey, float] = {}  # until when, as in time.monotonic()
+
+    def wait(self, key: SessionKey, seconds: float):
+        """a matcher waits for the next message of the player of `key`, for `seconds` at most"""
+        self._waiting[key] = time.monotonic() + seconds
+
+    def waited_on(self, key: SessionKey) -> bool:
+        """whether a matcher still waits for the next message of the player of `key`"""
+        until = self._waiting.get(key)
+        if until is not None and until <= time.monotonic():
+            del self._waiting[key]
+            until = None
+        return until is not None
+
+    def close(self, key: SessionKey):
+        super().close(key)
+        self._waiting.pop(key, None)
+
+    def evict_expired(self) -> int:
+        evicted = super().evict_expired()
+        for key in [key for key in self._waiting if key not in self]:
+            del self._waiting[key]
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        """number of games and groups, and an estimate of the memory the games take"""
+        sample = self.values()[-MEMORY_SAMPLE:]
+        per_session = sum(_deep_size(game, set()) for game in sample) / len(sample) if sample else 0
+        return {
+            'sessions': len(self),
+            'groups': len({group for group, _ in self if group}),
+            'memory_bytes': int(per_session * len(self)),
+        }
+
+
+SESSIONS = SessionManager()
@@ -0,0 +1,241 @@
+"""
+Monte Carlo simulator for the house rules implemented by `Blackjack`, batched with NumPy:
+every step (deal, a round of hits, a dealer draw) runs for all hands at once, so a million hands take about a second.
+
+The rules follow blackjack_game.py exactly, including the odd ones:
+player blackjack wins double, insurance wins the (full) bet when the dealer has blackjack and costs half the bet otherwise,
+5 cards not bust win double unless the dealer has blackjack, and the dealer draws to beat the player,
+accepting a tie by chance as in `Blackjack._dealer_hit`.
+
+`cross_check` plays seeded games through the real (scalar) `Blackjack` engine and asserts the batch gives the same results.
+"""
+import argparse
+import asyncio
+import time
+from random import Random
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .blackjack_game import Blackjack, Deck, Strategy, dealer_rng, CARD_VALUES, ACE_VALUE, NEW_PLAYER_MONEY
+from .database import MemoryLedger
+
+VALUES = np.array(CARD_VALUES, dtype=np.int8)
+MAX_TIE_DECISIONS = 16  # the dealer can't possibly face more tie decisions than this in one hand
+# no hand uses more cards than this (the player stops hitting at 5 cards, the dealer can't hold more than 11),
+# so only this many positions of each deck need shuffling
+MAX_CARDS_USED = 20
+BATCH_SIZE = 200_000  # hands per batch, bounds the memory used
+
+# outcome of each hand
+BLACKJACK, INSURANCE, BUST, CHARLIE, DEALER_BUST, PUSH, LOSE = range(7)
+OUTCOME_NAMES = ['blackjack', 'insurance paid', 'bust', '5-card charlie', 'dealer bust', 'push', 'lose']
+
+
+def _totals(hard: np.ndarray, has_ace: np.ndarray) -> np.ndarray:
+    """same as Hand.total"""
+    return np.where(has_ace & (hard + 10 <= 21), hard + 10, hard)
+
+
+class _Hands:
+    """hard totals, A flags and card counts of one side of every hand in the batch"""
+
+    def __init__(self, first: np.ndarray, second: np.ndarray):
+        self.hard = (VALUES[first] + VALUES[second]).astype(np.int16)
+        self.has_ace = (VALUES[first] == ACE_VALUE) | (VALUES[second] == ACE_VALUE)
+        self.count = np.full(len(first), 2, dtype=np.int8)
+
+    def add(self, idx: np.ndarray, cards: np.ndarray):
+        self.hard[idx] += VALUES[cards]
+        self.has_ace[idx] |= VALUES[cards] == ACE_VALUE
+        self.count[idx] += 1
+
+    def totals(self, idx=slice(None)) -> np.ndarray:
+        return _totals(self.hard[idx], self.has_ace[idx])
+
+
+def play_batch(decks: np.ndarray, tie_rolls: np.ndarray, strategy: Strategy, bet: int):
+    """
+    Plays one hand per row of `decks`
+    :param decks: (n, 52) shuffled decks, drawn from left to right like `Deck`
+    :param tie_rolls: (n, MAX_TIE_DECISIONS) uniform rolls in [0, 1) used in order by the dealer's tie decisions
+    :return: (net money won by the player, outcome code) for every hand
+    """
+    n = len(decks)
+    rows = np.arange(n)
+    # same dealing order as game_start: 2 dealer cards, then 2 player cards
+    dealer, player = _Hands(decks[:, 0], decks[:, 1]), _Hands(decks[:, 2], decks[:, 3])
+    position = np.full(n, 4, dtype=np.int16)
+    bets = np.full(n, bet, dtype=np.int64)
+    net = np.zeros(n, dtype=np.int64)
+    outcome = np.full(n, -1, dtype=np.int8)
+    dealer_blackjack = dealer.totals() == 21
+
+    def draw(idx: np.ndarray) -> np.ndarray:
+        cards = decks[idx, position[idx]]
+        position[idx] += 1
+        return cards
+
+    def settle(mask: np.ndarray, code: int, amount: np.ndarray):
+        net[mask] += amount[mask]
+        outcome[mask] = code
+
+    # player blackjack, wins double unless the dealer has one too
+    player_blackjack = player.totals() == 21
+    settle(player_blackjack & dealer_blackjack, PUSH, np.zeros(n, dtype=np.int64))
+    settle(player_blackjack & ~dealer_blackjack, BLACKJACK, 2 * bets)
+
+    # the dealer shows an A, insurance phase
+    insurance = (outcome < 0) & (VALUES[decks[:, 0]] == ACE_VALUE)
+    if strategy.take_insurance:
+        settle(insurance & dealer_blackjack, INSURANCE, bets)
+        paid = insurance & ~dealer_blackjack
+        net[paid] -= bets[paid] // 2
+
+    # player actions, doubling can only be the first action with this kind of strategy
+    in_play = outcome < 0
+    doubling = in_play & np.isin(player.totals(), strategy.double_on)
+    bets[doubling] *= 2
+    idx = np.nonzero(doubling)[0]
+    player.add(idx, draw(idx))
+    hitting = in_play & ~doubling
+    while True:
+        bust = in_play & (player.totals() > 21)
+        settle(bust, BUST, -bets)
+        in_play &= ~bust
+        hitting &= in_play & (player.totals() < strategy.stand_on) & (player.count < 5)
+        idx = np.nonzero(hitting)[0]
+        if len(idx) == 0:
+            break
+        player.add(idx, draw(idx))
+
+    # 5-card Charlie wins double, unless the dealer has blackjack
+    charlie = in_play & (player.count >= 5)
+    settle(charlie & ~dealer_blackjack, CHARLIE, 2 * bets)
+    settle(charlie & dealer_blackjack, LOSE, -bets)
+    in_play &= ~charlie
+
+    # the dealer draws to beat the player, see Blackjack._dealer_hit
+    player_totals = player.totals()
+    tie_count = np.zeros(n, dtype=np.int8)
+    drawing = in_play.copy()
+    while True:
+        dealer_totals = dealer.totals()
+        drawing &= (dealer_totals <= player_totals) & (dealer_totals != 21)
+        tie = drawing & (dealer_totals == player_totals)
+        roll = tie_rolls[rows, tie_count]
+        tie_count[tie] += 1
+        hit_chance = np.where(dealer_totals < 16, 0.8, np.where(dealer_totals <= 18, 0.5, 0.2))
+        drawing &= ~tie | (roll < hit_chance)  # a tie not drawn on is accepted
+        idx = np.nonzero(drawing)[0]
+        if len(idx) == 0:
+            break
+        dealer.add(idx, draw(idx))
+
+    dealer_totals = dealer.totals()
+    settle(in_play & (dealer_totals > 21), DEALER_BUST, bets)
+    settle(in_play & (dealer_totals == player_totals), PUSH, np.zeros(n, dtype=np.int64))
+    settle(in_play & (dealer_totals <= 21) & (dealer_totals > player_totals), LOSE, -bets)
+    return net, outcome
+
+
+class SimulationResult:
+    def __init__(self, strategy: Strategy, bet: int, hands: int, total: float, total_squares: float,
+                 outcome_counts: np.ndarray, seconds: float):
+        self.strategy, self.bet, self.hands, self.seconds = strategy, bet, hands, seconds
+        self.ev = total / hands  # expected net win per hand, in units of the base bet
+        self.variance = total_squares / hands - self.ev ** 2
+        self.outcomes: Dict[str, float] = {name: count / hands for name, count in zip(OUTCOME_NAMES, outcome_counts)}
+
+    def __str__(self):
+        lines = [f'strategy: {self.strategy}, bet {self.bet}',
+                 f'{self.hands} hands in {self.seconds:.2f}s ({self.hands / self.seconds:,.0f} hands/s)',
+                 f'player EV per hand: {self.ev:+.5f} bets (+- {2 * (self.variance / self.hands) ** 0.5:.5f}), '
+                 f'house edge {-self.ev:.3%}',
+                 f'variance: {self.variance:.4f} bets^2']
+        lines += [f'  {name:>15}: {share:.4%}' for name, share in self.outcomes.items()]
+        return '\n'.join(lines)
+
+
+def _shuffled_decks(rng: np.random.Generator, n: int) -> np.ndarray:
+    """(n, 52) decks whose first MAX_CARDS_USED positions are shuffled, a Fisher-Yates stopped early"""
+    decks = np.tile(np.arange(len(CARD_VALUES), dtype=np.int8), (n, 1))
+    rows = np.arange(n)
+    for i in range(MAX_CARDS_USED):
+        swap = rng.integers(i, len(CARD_VALUES), n)
+        picked = decks[rows, swap]
+        decks[rows, swap] = decks[:, i]
+        decks[:, i] = picked
+    return decks
+
+
+def simulate(hands: int, strategy: Strategy, bet: int = 100, seed: Optional[int] = None) -> SimulationResult:
+    """plays `hands` independent hands (fresh 52-card deck each) with `strategy` and reports the player's results"""
+    rng = np.random.default_rng(seed)
+    total = total_squares = 0.0
+    outcome_counts = np.zeros(len(OUTCOME_NAMES), dtype=np.int64)
+    start = time.perf_counter()
+    for begin in range(0, hands, BATCH_SIZE):
+        n = min(BATCH_SIZE, hands - begin)
+        net, outcome = play_batch(_shuffled_decks(rng, n), rng.random((n, MAX_TIE_DECISIONS)), strategy, bet)
+        units = net / bet
+        total += units.sum()
+        total_squares += (units ** 2).sum()
+        outcome_counts += np.bincount(outcome, minlength=len(OUTCOME_NAMES))
+    return SimulationResult(strategy, bet, hands, total, total_squares, outcome_counts, time.perf_counter() - start)
+
+
+async def _play_scalar(seed: int, strategy: Strategy, bet: int) -> int:
+    """plays one game through the real engine, returns the player's net win"""
+    ledger = MemoryLedger()
+    game = Blackjack(bet, 'player', 'dealer', seed=seed, ledger=ledger)
+    message = await game.game_start()
+    while message.bot_action != message.BOT_FINISH:
+        message = await game.receive_input(strategy.action(game))
+    return ledger.money['player'] - NEW_PLAYER_MONEY
+
+
+def cross_check(games: int, strategy: Strategy, bet: int = 100, first_seed: int = 0) -> int:
+    """
+    Plays seeds first_seed, first_seed + 1... through both the scalar `Blackjack` engine and `play_batch`,
+    feeding the batch the same decks and dealer rolls, and asserts every result matches
+    :return: number of games checked
+    """
+    seeds = range(first_seed, first_seed + games)
+    decks, tie_rolls = [], []
+    for seed in seeds:
+        # replicate what Blackjack(seed=seed) does: shuffle once, then the rolls of _dealer_hit
+        decks.append(Deck(Random(seed)).cards)
+        rng = dealer_rng(seed)
+        tie_rolls.append([rng.random() for _ in range(MAX_TIE_DECISIONS)])
+    decks = np.frombuffer(b''.join(decks), dtype=np.int8).reshape(games, len(CARD_VALUES))
+    batch_net, _ = play_batch(decks, np.array(tie_rolls), strategy, bet)
+
+    async def play_all() -> List[int]:
+        return [await _play_scalar(seed, strategy, bet) for seed in seeds]
+    scalar_net = asyncio.run(play_all())
+
+    mismatches = [(seed, scalar, int(batch)) for seed, scalar, batch in zip(seeds, scalar_net, batch_net)
+                  if scalar != batch]
+    assert not mismatches, f'engine and simulator disagree (seed, engine, simulator): {mismatches[:10]}'
+    return games
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monte Carlo simulation of the blackjack house rules')
+    parser.add_argument('-n', '--hands', type=int, default=1_000_000)
+    parser.add_argument('--stand-on', type=int, default=17, help='hit while the hand is below this total')
+    parser.add_argument('--double-on', type=int, nargs='*', default=[], help='totals to double on, as first action')
+    parser.add_argument('--insurance', action='store_true', help='always take insurance')
+    parser.add_argument('--bet', type=int, default=100)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--cross-check', type=int, metavar='GAMES',
+                        help='instead of simulating, check the simulator against the engine on this many seeded games')
+    args = parser.parse_args()
+
+    strategy = Strategy(args.stand_on, tuple(args.double_on), args.insurance)
+    if args.cross_check:
+        cross_check(args.cross_check, strategy, args.bet, args.seed or 0)
+        print(f'{args.cross_check} seeded games match the Blackjack engine, strategy: {strategy}')
+    else:
+        print(simulate(args.hands, strategy, args.bet, args.seed))
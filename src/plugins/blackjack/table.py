@@ -0,0 +1,197 @@
+"""
+Table mode: one dealer against up to TABLE_MAX_PLAYERS players of a group, all dealt from the same deck.
+
+Players act at the same time within a shared TABLE_ACTION_TIMEOUT, whoever hasn't finished by then stands.
+With several players the dealer can't draw to beat "the" player like `Blackjack._dealer_hit`, so at a table the dealer
+draws below DEALER_STANDS_ON. Blackjack and 5-card Charlie still win double, but unlike a one-on-one game a table
+offers no insurance against the dealer's ace, and players can only double on their first two cards.
+The whole round is settled at once with ledger.transfer_many, one flush writes every payout.
+"""
+import asyncio
+from enum import Enum
+from random import Random, getrandbits
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from .blackjack_game import Hand, Deck, Shoe, CARD_NAMES, NEW_PLAYER_MONEY
+from .database import DB, BlackjackDatabase
+
+TABLE_MAX_PLAYERS = 5
+TABLE_ACTION_TIMEOUT = 60  # seconds players have to finish their hands, those who haven't then stand
+TABLE_OPEN_TIMEOUT = 5 * 60  # seconds an open table waits to be started before it's closed
+DEALER_STANDS_ON = 17
+TABLE_ACTIONS = ['要牌', '双倍', '停牌']
+
+
+class Seat:
+    __slots__ = ('qq', 'hand', 'bet', 'doubled', 'done')
+
+    def __init__(self, qq: str, bet: int):
+        self.qq, self.bet = qq, bet
+        self.hand = Hand()
+        self.doubled = False
+        self.done = False  # stood, bust, or can't act anymore
+
+
+class Table:
+    class Phase(Enum):
+        OPEN = 1  # waiting for players to join
+        PLAYING = 2
+        SETTLING = 3
+
+    def __init__(self, group_id: str, dealer_qq: str, bet: int, seed: Optional[int] = None,
+                 ledger: BlackjackDatabase = DB, next_shoe: Optional[Callable[[], Optional[Shoe]]] = None):
+        """
+        :param next_shoe: called when the table deals for the shoe to deal from, i.e. the group's (see Blackjack);
+        a fresh deck shuffled by `seed` is dealt without it, or if it gives None
+        """
+        self.group_id, self.dealer_qq, self.bet = group_id, dealer_qq, bet
+        self.ledger = ledger
+        self.seed = seed if seed is not None else getrandbits(64)
+        self.next_shoe = next_shoe
+        self.deck: Optional[Union[Deck, Shoe]] = None
+        self.dealer_hand = Hand()
+        self.seats: Dict[str, Seat] = {}  # by qq, in joining order
+        self.phase = self.Phase.OPEN
+        self.timer: Optional[asyncio.Task] = None
+
+    def join(self, qq: str) -> str:
+        if self.phase != self.Phase.OPEN:
+            return '这桌已经开始了，等下一桌吧'
+        if qq == self.dealer_qq:
+            return '庄家不能自己下场'
+        if qq in self.seats:
+            return '你已经在桌上了'
+        if len(self.seats) >= TABLE_MAX_PLAYERS:
+            return f'这桌已经坐满{TABLE_MAX_PLAYERS}人了'
+        self.seats[qq] = Seat(qq, self.bet)
+        return f'{qq}入座（{len(self.seats)}/{TABLE_MAX_PLAYERS}），庄家{self.dealer_qq}\n发送 “加入” 入座，“开始” 发牌'
+
+    def _describe(self, seat: Seat) -> str:
+        return f"{seat.qq}：{'，'.join(seat.hand.names())}，共计{seat.hand.total}点"
+
+    def deal(self) -> str:
+        """deals everyone, :returns the opening hands and the actions"""
+        self.phase = self.Phase.PLAYING
+        # asked only now, other games of the group went on dealing from its shoe since the table opened
+        self.deck = self.next_shoe() if self.next_shoe is not None else None
+        if self.deck is None:
+            self.deck = Deck(Random(self.seed))
+            print('blackjack table', self.group_id, 'dealt, seed is', self.seed)
+        # the first dealer card is the visible one, like in Blackjack
+        self.dealer_hand.add(self.deck.draw())
+        self.dealer_hand.add(self.deck.draw())
+        lines = []
+        for seat in self.seats.values():
+            seat.hand.add(self.deck.draw())
+            seat.hand.add(self.deck.draw())
+            if seat.hand.total == 21:
+                seat.done = True
+                lines.append(self._describe(seat) + '，黑杰克！')
+            else:
+                lines.append(self._describe(seat))
+        lines.append(f'庄家的明牌是{CARD_NAMES[self.dealer_hand[0]]}')
+        lines.append(f"{TABLE_ACTION_TIMEOUT}秒内各自行动：{'，'.join(TABLE_ACTIONS)}，超时自动停牌")
+        return '\n'.join(lines)
+
+    def act(self, qq: str, action: str) -> Optional[str]:
+        """plays `action` for the player `qq`, :returns the response, None if `qq` can't act now"""
+        seat = self.seats.get(qq)
+        if self.phase != self.Phase.PLAYING or seat is None or seat.done or action not in TABLE_ACTIONS:
+            return None
+        if action == '停牌':
+            seat.done = True
+            return self._describe(seat) + '，停牌'
+        if action == '双倍':
+            if len(seat.hand) != 2:
+                return f'{qq}：只有头两张牌可以双倍'
+            seat.bet *= 2
+            seat.doubled = True
+            seat.done = True  # one card only after doubling
+        seat.hand.add(self.deck.draw())
+        if seat.hand.total > 21:
+            seat.done = True
+            return self._describe(seat) + '，爆了'
+        if len(seat.hand) >= 5:
+            seat.done = True
+            return self._describe(seat) + '，五小龙'
+        return self._describe(seat)
+
+    @property
+    def all_done(self) -> bool:
+        return all(seat.done for seat in self.seats.values())
+
+    def _outcome(self, seat: Seat, dealer_total: int, dealer_blackjack: bool) -> Tuple[str, int]:
+        """(outcome, what the player wins) of a settled seat, see the house rules in Blackjack"""
+        hand = seat.hand
+        if hand.total > 21:
+            return 'bust', -seat.bet
+        if len(hand) == 2 and hand.total == 21:
+            return ('push', 0) if dealer_blackjack else ('blackjack', 2 * seat.bet)
+        if dealer_blackjack:
+            return 'lose', -seat.bet
+        if len(hand) >= 5:
+            return 'charlie', 2 * seat.bet
+        if dealer_total > 21:
+            return 'dealer_bust', seat.bet
+        if dealer_total == hand.total:
+            return 'push', 0
+        return ('lose', -seat.bet) if dealer_total > hand.total else ('win', seat.bet)
+
+    async def settle(self) -> str:
+        """stands whoever is left, plays the dealer, pays everyone in one ledger batch; :returns the results"""
+        self.phase = self.Phase.SETTLING
+        self.cancel_timer()
+        for qq in [self.dealer_qq] + list(self.seats):
+            if await self.ledger.get_money(qq) is None:
+                await self.ledger.insert_new(qq, NEW_PLAYER_MONEY)
+        dealer_blackjack = self.dealer_hand.total == 21
+        # the dealer only draws if some hand is still to be beaten
+        contested = [seat for seat in self.seats.values()
+                     if seat.hand.total <= 21 and len(seat.hand) < 5 and not (len(seat.hand) == 2 and seat.hand.total == 21)]
+        while contested and not dealer_blackjack and self.dealer_hand.total < DEALER_STANDS_ON:
+            self.dealer_hand.add(self.deck.draw())
+        dealer_total = self.dealer_hand.total
+
+        results = {seat.qq: self._outcome(seat, dealer_total, dealer_blackjack) for seat in self.seats.values()}
+        balances = await self.ledger.transfer_many(self.dealer_qq, [(qq, won) for qq, (_, won) in results.items()])
+        for seat in self.seats.values():
+            outcome, won = results[seat.qq]
+            await self.ledger.record_hand(seat.qq, self.dealer_qq, seat.bet, seat.doubled, False, outcome, won)
+
+        lines = [f"庄家手牌：{'，'.join(self.dealer_hand.names())}，共计{dealer_total}点"
+                 + ('，黑杰克' if dealer_blackjack else '，爆了' if dealer_total > 21 else '')]
+        for seat in self.seats.values():
+            won = results[seat.qq][1]
+            result = f'赢了{won}' if won > 0 else f'输了{-won}' if won < 0 else '平局'
+            lines.append(f'{self._describe(seat)}，{result}，余额{balances[seat.qq]}')
+        lines.append(f'庄家{self.dealer_qq}余额{balances[self.dealer_qq]}')
+        return '\n'.join(lines)
+
+    def start_timer(self, delay: float, callback: Callable[[], Awaitable]):
+        """runs `callback` after `delay` seconds, replacing the previous timer"""
+        self.cancel_timer()
+
+        async def expire():
+            await asyncio.sleep(delay)
+            self.timer = None
+            await callback()
+        self.timer = asyncio.ensure_future(expire())
+
+    def cancel_timer(self):
+        # the timer's own callback may get here, it must not cancel itself
+        if self.timer is not None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+        self.timer = None
+
+    def __contains__(self, qq: str) -> bool:
+        return qq in self.seats
+
+
+# group id -> its table, one per group
+TABLES: Dict[str, Table] = {}
+
+
+def table_of(qq: str, group_id: str) -> Optional[Table]:
+    """the table of `group_id` if `qq` sits at it"""
+    table = TABLES.get(group_id)
+    return table if table is not None and qq in table else None
@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+
+MAX_BUCKETS = 10000  # per throttle, the least recently used bucket is dropped past this
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated', 'warned')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens, self.updated = tokens, updated
+        self.warned = False  # the owner was told off since their last accepted request
+
+
+class Throttle:
+    """
+    Token buckets by key (a user, a group...), all in memory: every key may spend up to `burst` requests at once,
+    and earns back `rate` requests per second. Checking costs no db access, so spam is turned away before reaching it
+    The buckets are kept in LRU order and at most `max_buckets` of them, a dropped bucket comes back full,
+    which is what an idle one would have refilled to anyway
+    """
+
+    def __init__(self, rate: float, burst: float, max_buckets: int = MAX_BUCKETS):
+        self.rate, self.burst, self.max_buckets = rate, burst, max_buckets
+        self._buckets: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+
+    def _bucket(self, key: str) -> TokenBucket:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def acquire(self, key: str) -> bool:
+        """takes one request from `key`'s bucket, False if it's empty"""
+        bucket = self._bucket(key)
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        bucket.warned = False
+        return True
+
+    def should_warn(self, key: str) -> bool:
+        """True only for the first refused request since the last accepted one, so refusals aren't spammed back"""
+        bucket = self._bucket(key)
+        warn, bucket.warned = not bucket.warned, True
+        return warn
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,115 @@
+"""
+Values kept by key between messages, forgotten once unused for a while: the blackjack games in progress, the bilibili
+drafts. Outside src/plugins so nonebot doesn't load it as a plugin.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Iterator, List, Optional, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+EVICT_INTERVAL = 60  # seconds between two sweeps of idle entries
+
+
+class TTLRegistry(Generic[K, V]):
+    """
+    Values by key, each dropped once unused for `timeout` seconds, no more than `max_entries` at once.
+    `on_drop` is called with every value the registry drops (expired, replaced or closed), not the ones taken out
+    """
+
+    def __init__(self, name: str, timeout: float, max_entries: int, on_drop: Optional[Callable[[V], None]] = None):
+        self.name, self.timeout, self.max_entries, self.on_drop = name, timeout, max_entries, on_drop
+        # key -> [value, last use as in time.monotonic()], least recently used first, so expired ones are in front
+        self._entries: 'OrderedDict[K, list]' = OrderedDict()
+        self._evict_task: Optional[asyncio.Task] = None
+
+    def _drop(self, key: K):
+        entry = self._entries.pop(key, None)
+        if entry is not None and self.on_drop is not None:
+            self.on_drop(entry[0])
+
+    def open(self, key: K, value: V) -> bool:
+        """registers `value` for `key`, dropping the previous one; False if there are too many, `value` isn't kept"""
+        self.evict_expired()
+        self._drop(key)
+        if len(self._entries) >= self.max_entries:
+            return False
+        self._entries[key] = [value, time.monotonic()]
+        return True
+
+    def _touch(self, key: K) -> Optional[list]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if now - entry[1] > self.timeout:
+            self._drop(key)
+            return None
+        entry[1] = now
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key: K) -> Optional[V]:
+        """the value of `key` and marks it used, None if there is none or it expired"""
+        entry = self._touch(key)
+        return entry[0] if entry is not None else None
+
+    def peek(self, key: K) -> Optional[V]:
+        """the value of `key`, expired or not, without marking it used"""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def take(self, key: K) -> Optional[V]:
+        """removes the value of `key` and hands it over, None if there is none or it expired"""
+        entry = self._touch(key)
+        if entry is None:
+            return None
+        del self._entries[key]
+        return entry[0]
+
+    def close(self, key: K):
+        self._drop(key)
+
+    def evict_expired(self) -> int:
+        """drops the values unused for `timeout`, :returns how many"""
+        deadline = time.monotonic() - self.timeout
+        evicted = 0
+        while self._entries:
+            key, (_, last_used) = next(iter(self._entries.items()))
+            if last_used > deadline:
+                break
+            self._drop(key)
+            evicted += 1
+        if evicted:
+            print(self.name, 'evicted', evicted)
+        return evicted
+
+    def values(self) -> List[V]:
+        """least recently used first"""
+        return [value for value, _ in self._entries.values()]
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(EVICT_INTERVAL)
+            self.evict_expired()
+
+    def start(self):
+        """starts sweeping idle values periodically, call it once the event loop is running"""
+        if self._evict_task is None:
+            self._evict_task = asyncio.ensure_future(self._evict_loop())
+
+    def stop(self):
+        if self._evict_task is not None:
+            self._evict_task.cancel()
+            self._evict_task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self._entries)
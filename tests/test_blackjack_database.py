@@ -0,0 +1,168 @@
+import asyncio
+import sqlite3
+from random import Random
+
+from src.plugins.blackjack.blackjack_game import Blackjack, Shoe
+from src.plugins.blackjack.database import BlackjackDatabase, MemoryLedger, STATS_FIELDS
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def read(db_path, query, args=()):
+    """what is actually in the db file, through a connection of its own"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(query, args).fetchall()
+    finally:
+        conn.close()
+
+
+def balances(db_path):
+    return dict(read(db_path, 'SELECT qq, money FROM blackjack'))
+
+
+def test_transfers_are_written_by_flush(tmp_path):
+    db_path = str(tmp_path / 'blackjack.db')
+
+    async def main():
+        db = BlackjackDatabase(db_path)
+        for qq in 'abc':
+            await db.insert_new(qq, 500)
+        assert await db.transfer('a', 'b', 100) == (400, 600)
+        assert await db.transfer_many('a', [('b', 50), ('c', -20)]) == {'a': 370, 'b': 650, 'c': 480}
+        assert balances(db_path) == {}  # written behind
+        await db.flush()
+        assert balances(db_path) == {'a': 370, 'b': 650, 'c': 480}
+        assert await db.get_money('a') == 370
+        await db.close()
+
+    run(main())
+
+
+def test_failed_flush_is_rolled_back_and_retried(tmp_path):
+    db_path = str(tmp_path / 'blackjack.db')
+    # the balances are written first in the flush transaction, then the stats fail
+    fail = '''CREATE TRIGGER fail BEFORE INSERT ON blackjack_stats BEGIN SELECT RAISE(ABORT, 'disk full');
+              END'''
+
+    async def main():
+        db = BlackjackDatabase(db_path)
+        await db.insert_new('a', 500)
+        await db.insert_new('b', 500)
+        await db.flush()
+        read(db_path, fail)
+        await db.transfer_many('a', [('b', 100)])
+        await db.record_hand('b', 'a', 100, False, False, 'win', 100)
+        await db.flush()
+        assert balances(db_path) == {'a': 500, 'b': 500}
+        assert read(db_path, 'SELECT count(*) FROM blackjack_history') == [(0,)]
+
+        read(db_path, 'DROP TRIGGER fail')
+        await db.flush()
+        assert balances(db_path) == {'a': 400, 'b': 600}
+        assert read(db_path, 'SELECT count(*) FROM blackjack_history') == [(1,)]
+
+        # changed again before the retry: the newest balance is written, the stats of both hands are summed
+        read(db_path, fail)
+        await db.transfer('a', 'b', 50)
+        await db.record_hand('b', 'a', 50, False, False, 'win', 50)
+        await db.flush()
+        await db.transfer('a', 'b', 10)
+        await db.record_hand('b', 'a', 10, False, False, 'win', 10)
+        read(db_path, 'DROP TRIGGER fail')
+        await db.flush()
+        assert balances(db_path) == {'a': 340, 'b': 660}
+        assert read(db_path, 'SELECT count(*) FROM blackjack_history') == [(3,)]
+        stats = read(db_path, f'SELECT {", ".join(STATS_FIELDS)} FROM blackjack_stats WHERE qq=?', ('b',))
+        assert stats == [(3, 3, 160, 100, 0, 0)]
+        await db.close()
+
+    run(main())
+
+
+def test_failed_flush_does_not_bring_back_a_deleted_snapshot(tmp_path):
+    async def main():
+        db = BlackjackDatabase(str(tmp_path / 'blackjack.db'))
+        key = ('group', 'p')
+        write = db._write
+        failures = [sqlite3.OperationalError('database is locked')]
+
+        def fail_once(*args):
+            if failures:
+                raise failures.pop()
+            return write(*args)
+        db._write = fail_once
+
+        await db.save_session(key, 'd', b'old')
+        failing = asyncio.ensure_future(db.flush())  # takes the snapshot, then fails
+        await asyncio.sleep(0)
+        await db.delete_session(key)  # the game ended meanwhile
+        await db.flush()  # writes the deletion after the failed write
+        await failing
+        await db.flush()
+        assert await db.load_session(key) is None
+        assert read(db.db_path, 'SELECT count(*) FROM blackjack_session') == [(0,)]
+
+        # a snapshot nothing replaced is written by the next flush
+        failures.append(sqlite3.OperationalError('database is locked'))
+        await db.save_session(key, 'd', b'new')
+        await db.flush()
+        await db.flush()
+        assert read(db.db_path, 'SELECT state FROM blackjack_session') == [(b'new',)]
+        await db.close()
+
+    run(main())
+
+
+def test_get_stats_counts_pending_stats(tmp_path):
+    async def main():
+        db = BlackjackDatabase(str(tmp_path / 'blackjack.db'))
+        assert await db.get_stats('p') is None
+        await db.record_hand('p', 'd', 100, True, False, 'win', 200)
+        await db.record_rob('p', 'fail', -30)
+        expected = {'hands': 1, 'wins': 1, 'net': 200, 'biggest_win': 200, 'robs': 1, 'rob_net': -30}
+        assert await db.get_stats('p') == expected  # nothing flushed yet
+
+        await db.flush()
+        await db.record_hand('p', 'd', 100, False, False, 'win', 100)  # flushed and pending ones together
+        expected.update(hands=2, wins=2, net=300)
+        assert await db.get_stats('p') == expected
+        assert (await db.get_stats('d'))['net'] == -300
+        await db.close()
+
+    run(main())
+
+
+def test_snapshot_restore_round_trip(tmp_path):
+    async def main():
+        db = BlackjackDatabase(str(tmp_path / 'blackjack.db'))
+        key = ('group', 'p')
+        for seed in range(40):
+            choices = Random(seed)
+            shoe_seed = seed if seed % 2 else None  # half from a fresh deck, half from a shoe
+            ledger, twin_ledger = MemoryLedger(), MemoryLedger()
+            game = Blackjack(100, 'p', 'd', seed=seed, ledger=ledger,
+                             shoe=Shoe(2, seed=shoe_seed) if shoe_seed is not None else None)
+            twin = Blackjack(100, 'p', 'd', seed=seed, ledger=twin_ledger,
+                             shoe=Shoe(2, seed=shoe_seed) if shoe_seed is not None else None)
+            message, twin_message = await game.game_start(), await twin.game_start()
+            while message.bot_action != message.BOT_FINISH:
+                await db.save_session(key, 'd', game.snapshot())
+                await db.flush()
+                dealer_qq, data, _ = await db.load_session(key)
+                restored = await Blackjack.restore(data, 'p', dealer_qq, ledger=ledger)
+                assert restored.snapshot() == game.snapshot()
+
+                action = choices.choice(game.PHASE_ACTIONS[game.game_phase])
+                game = restored  # plays on exactly like the game that was never stored
+                message, twin_message = await game.receive_input(action), await twin.receive_input(action)
+                assert message.response == twin_message.response
+            assert ledger.money == twin_ledger.money
+        await db.delete_session(key)
+        await db.flush()
+        assert await db.load_session(key) is None
+        await db.close()
+
+    run(main())
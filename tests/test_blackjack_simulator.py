@@ -0,0 +1,13 @@
+from src.plugins.blackjack.blackjack_game import Strategy
+from src.plugins.blackjack.database import DB
+from src.plugins.blackjack.simulator import cross_check, simulate
+
+
+def test_simulator_matches_the_engine():
+    assert cross_check(300, Strategy(17)) == 300
+
+
+def test_simulator_leaves_the_db_alone():
+    simulate(10_000, Strategy(16), seed=1)
+    cross_check(50, Strategy(12))
+    assert DB.conn is None  # never opened: the simulated games only use a MemoryLedger